@@ -13,6 +13,12 @@ function! VimShRedraw()
     redraw
 endfunction
 
+"  Insert mode completion at the prompt, see complete_at_prompt() in vimsh.py
+function! VimShComplete()
+    python complete_at_prompt()
+    return g:vimsh_complete_ret
+endfunction
+
 if has("python")
 
     " Only load vimsh.py once (don't reset variables)
@@ -24,6 +30,58 @@ if has("python")
         if exists( "g:vimsh_loaded_ok" )
             "  Use ':VimshNewBuf name' to open a new buffer '_name_'
             command! -nargs=1 VimShNewBuf python spawn_buf( "_<args>_" )
+
+            "  Don't leave warm shells from the pool lying around
+            autocmd VimLeave * python drain_pool()
+
+            "  Keep each shell's pty the size of its window
+            autocmd VimResized,WinEnter,BufWinEnter * python sync_winsizes()
+
+            if exists( "##WinResized" )
+                autocmd WinResized * python sync_winsizes()
+            endif
+
+            "  Daemon backed shells ( g:vimsh_daemon )
+            command! -nargs=0 VimShDetach   python detach_buf()
+            command! -nargs=0 VimShSessions python list_sessions()
+            command! -nargs=1 VimShKill     python kill_session( "_<args>_" )
+
+            "  Search the command history for a substring
+            command! -nargs=1 VimShHistory  python search_history( <q-args> )
+
+            "  Move between, fold and yank the output of past commands
+            command! -nargs=0 VimShNextOutput  python current_call( 'jump_output', 1 )
+            command! -nargs=0 VimShPrevOutput  python current_call( 'jump_output', 0 )
+            command! -nargs=0 VimShFoldOutputs python current_call( 'fold_outputs' )
+            command! -count=1 VimShYankOutput  python current_call( 'yank_output', <count> )
+
+            "  Search the output of every vimsh buffer into the quickfix list
+            command! -nargs=1 VimShGrep python grep_all( <q-args> )
+
+            "  List hooks or toggle one for this buffer ( see register_hook )
+            command! -nargs=? VimShHook python current_call( 'toggle_hook', <q-args> )
+
+            "  Collect compiler/test errors into the quickfix list as they're printed
+            command! -nargs=0 VimShErrors python current_call( 'toggle_errors' )
+
+            "  Show runs of the same line once with a repeat count
+            command! -nargs=0 VimShCompact python current_call( 'toggle_compact' )
+
+            "  Send keys to the shell as they're typed, ^] goes back
+            command! -nargs=0 VimShRaw python current_call( 'raw_mode' )
+
+            "  Bytes read, outputs, raw mode key to screen latency per buffer
+            command! -nargs=0 VimShStats python show_stats()
+
+            "  Outputs thrown away by clear, :VimShArchive n restores one
+            command! -nargs=? VimShArchive python show_archive( <q-args> )
+
+            "  Record a buffer's raw pty traffic, replay it into a new buffer
+            command! -nargs=? -complete=file VimShRecord python current_call( 'toggle_record', <q-args> )
+            command! -nargs=+ -complete=file VimShReplay python replay( <q-args> )
+
+            "  Run a command in several vimsh buffers at once, i.e. -s host1,host2 uptime
+            command! -nargs=+ VimShBroadcast python broadcast( <q-args> )
         endif
 
         let g:vimsh_loaded_python_file=1
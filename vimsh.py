@@ -6,8 +6,8 @@
 # author:   brian m sturk   bsturk@comcast.net,
 #                           http://home.comcast.net/~bsturk/vim.html
 # created:  12/02/01
-# last_mod: 02/08/10
-# version:  0.21
+# last_mod: 10/19/26
+# version:  0.22
 #
 # usage, etc:   see README
 # history:      see CHANGELOG
@@ -22,12 +22,28 @@
 
 _DEBUG_   = 0
 _BUFFERS_ = []
+_POOL_    = []
+_HISTORY_ = None
+_EXES_    = None
+_DIRS_    = None
+_INDEX_   = None
+_ARCHIVE_ = None
+_NEXT_SID_ = 0
+_HOOKS_   = {}
 init_ok   = 0
 
 ################################################################################
 
+##  Without vim this is a library, see vimsh_headless
+
+try:
+    import vim
+
+except ImportError:
+    vim = None
+
 try:
-    import vim, sys, os, string, signal, re, time
+    import sys, os, string, signal, re, time, bisect, array, struct, zlib, stat
 
     if sys.platform == 'win32':
 
@@ -40,42 +56,89 @@ try:
         use_pty = 0
 
     else:
-        import pty, tty, select
+        import pty, tty, select, socket, errno, fcntl, termios
         use_pty = 1
 
-    vim.command( 'let g:vimsh_loaded_ok = "1"' )
+    if vim:
+        vim.command( 'let g:vimsh_loaded_ok = "1"' )
+
     init_ok = 1
 
 except ImportError, e:
 
-    vim.command( 'let g:vimsh_load_error = "' + str( e ) + '"' )
+    if vim:
+        vim.command( 'let g:vimsh_load_error = "' + str( e ) + '"' )
+
     init_ok = 0
 
+##  Optional, scandir gives us file types without a stat per entry
+
+scandir = getattr( os, 'scandir', None )
+
+if scandir == None:
+
+    try:
+        from scandir import scandir
+
+    except ImportError:
+        scandir = None
+
 ################################################################################
-##                             class vimsh                                    ##
+##                          class vimsh_engine                                ##
 ################################################################################
 
-class vimsh:
-    def __init__( self, _sh, _arg, _filename ):
+class vimsh_engine:
+
+    ##  The shell and its pty ( or pipes, or daemon connection ), without
+    ##  any vim.  Output goes to self.sink, which has:
+    ##
+    ##      print_lines( lines )    pieces of output from process_read, a
+    ##                              piece ending in '\r' finishes a line
+    ##      end_read( any_read )    the read timed out, nothing more for now
+    ##      redraw()                a good time to show progress
+    ##
+    ##  vimsh is the sink for vim buffers, vimsh_memory_sink collects
+    ##  output for scripts ( see vimsh_headless ).
+
+    def __init__( self, _sh, _arg, _filename = None ):
 
         self.sh        = _sh
         self.arg       = _arg
-        self.filename  = _filename
-
-        self.prompt_line, self.prompt_cursor = self.get_vim_cursor_pos()
+        self.filename  = _filename      ##  also the session name in the daemon
 
-        self.password_regex   = [ '^\s*Password:',         ##  su, ssh, ftp
-                                  'password:',             ##  ???, seen this somewhere
-                                  'Password required' ]    ##  other ftp clients
+        self.sink      = None
+        self.read_size = 32             ##  bytes per os.read of the pty
 
         self.shell_exited          = 0
         self.last_cmd_executed     = 'foobar'
         self.keyboard_interrupt    = 0
-        self.buffer                = vim.current.buffer
+
+        self.daemon                = 0      ##  ptys owned by vimsh_daemon
+        self.detached              = 0
+        self.replay                = 0      ##  no shell, output from a recording
+        self.stream_offset         = 0      ##  bytes of output seen so far
+
+        ##  Filter stages from register_hook, empty unless some are enabled
+        ##  for this session so the normal path doesn't pay for them
+
+        self.hooks                 = []
+        self.chunk_stages          = []
+        self.line_stages           = []
+        self.write_stages          = []
+        self.partial               = ''     ##  incomplete line held from line stages
+
+        for name, ( kind, func, default ) in _HOOKS_.items():
+            if default:
+                self.enable_hook( name )
+
+        self.recorder              = None   ##  file raw pty traffic is logged to
+        self.record_start          = 0
+
+        self.winsize               = None   ##  ( rows, cols ) the pty was last told
 
 ################################################################################
 
-    def setup_pty( self, _use_pty ):
+    def setup_pty( self, _use_pty, _warm = None, _sigchld = 1 ):
 
         self.using_pty = _use_pty
 
@@ -105,56 +168,37 @@ class vimsh:
             self.master, pty_name = pty.master_open()
             dbg_print ( 'setup_pty: slave pty name is ' + pty_name )
 
-            self.pid, self.fd = pty.fork()
+            ##  A warm shell from the pool has already been forked and is
+            ##  sitting at its first prompt, just adopt it.
+
+            if _warm:
+                self.pid, self.fd = _warm
+
+            else:
+                self.pid, self.fd = spawn_pty( self.sh, self.arg )
 
             self.outd = self.fd
             self.ind  = self.fd
             self.errd = self.fd
 
-            signal.signal( signal.SIGCHLD, self.sigchld_handler )
+            ##  Not for vimsh_headless, a library can't take SIGCHLD away
+            ##  from the program using it
 
-            if self.pid == 0:
-
-                ##  In spawned shell process, NOTE: any 'print'ing done within
-                ##  here will corrupt vim.
+            if _sigchld:
+                signal.signal( signal.SIGCHLD, self.sigchld_handler )
 
+            try:
                 attrs = tty.tcgetattr( 1 )
+                termios_keys = attrs[ 6 ]
 
-                attrs[ 6 ][ tty.VMIN ]  = 1
-                attrs[ 6 ][ tty.VTIME ] = 0
-                attrs[ 0 ] = attrs[ 0 ] | tty.BRKINT
-                attrs[ 0 ] = attrs[ 0 ] & tty.IGNBRK
-                attrs[ 3 ] = attrs[ 3 ] & ~tty.ICANON & ~tty.ECHO
-
-                tty.tcsetattr( 1, tty.TCSANOW, attrs )
-
-                try:
-
-                    if self.arg != '':
-                        os.execv( self.sh, [ self.sh, self.arg ] )
-
-                    else:
-                        os.execv( self.sh, [ self.sh, ] )
-
-                except:
-
-                    print( 'setup_pty: Couldn\'t start specified shell ' + self.sh )
-                    return
-
-            else:
-
-                try:
-                    attrs = tty.tcgetattr( 1 )
-                    termios_keys = attrs[ 6 ]
-
-                except:
-                    dbg_print ( 'setup_pty: tcgetattr failed' )
-                    return
+            except:
+                dbg_print ( 'setup_pty: tcgetattr failed' )
+                return
 
-                ##  Get *real* key-sequence for standard input keys, i.e. EOF
+            ##  Get *real* key-sequence for standard input keys, i.e. EOF
 
-                self.eof_key   = termios_keys[ tty.VEOF ]
-                self.intr_key  = termios_keys[ tty.VINTR ]
+            self.eof_key   = termios_keys[ tty.VEOF ]
+            self.intr_key  = termios_keys[ tty.VINTR ]
 
         else:
 
@@ -179,107 +223,135 @@ class vimsh:
 
 ################################################################################
 
-    def execute_cmd( self, _cmd = None, _null_terminate = 1 ):
+    def setup_daemon( self ):
 
-        had_non_keyb_exception = 0
+        ##  Same as setup_pty but the shell lives in vimsh_daemon, which
+        ##  spawns it if it doesn't exist yet.  Returns the output we
+        ##  haven't seen ( all of the kept scrollback for a new vim ).
 
-        dbg_print ( 'execute_cmd: Entered cmd is ' + str( _cmd ) )
+        self.using_pty = 1
+        self.daemon    = 1
+        self.delay     = 0.2
 
-        if self.keyboard_interrupt:
+        self.sock = daemon_connect()
 
-            dbg_print( 'execute_cmd: keyboard interrupt earlier, cleaning up' )
+        req = [ 'attach', self.filename, self.sh, self.arg, str( self.stream_offset ) ]
+        self.sock.sendall( string.join( req, '\t' ) + '\n' )
 
-            self.page_output( 1 )
-            self.keyboard_interrupt = 0
+        reply = string.split( sock_read_line( self.sock ), '\t' )
 
-            return
+        if reply[ 0 ] != 'ok':
+            raise IOError( 'setup_daemon: attach failed ' + str( reply ) )
 
-        ##  This is the main worker function
+        self.pid = int( reply[ 1 ] )
+        start    = int( reply[ 2 ] )
+        tail     = sock_read_exact( self.sock, int( reply[ 3 ] ) )
+
+        dbg_print( 'setup_daemon: attached to pid %d, replaying %d bytes from %d' % ( self.pid, len( tail ), start ) )
+
+        self.stream_offset = start + len( tail )
+        self.detached      = 0
+        self.winsize       = None       ##  may be a different vim, tell it again
+
+        self.outd = self.sock.fileno()
+        self.ind  = self.outd
+        self.errd = self.outd
 
         try:
+            termios_keys = tty.tcgetattr( 1 )[ 6 ]
 
-            print ''            ##  Clears the ex command window
+            self.eof_key   = termios_keys[ tty.VEOF ]
+            self.intr_key  = termios_keys[ tty.VINTR ]
 
-            cur = self.buffer
-            cur_line, cur_row = self.get_vim_cursor_pos()
+        except:
+            dbg_print ( 'setup_daemon: tcgetattr failed' )
 
-            if _cmd == None:
+        return tail
 
-                ##  Grab everything from the prompt to the current cursor position.
+################################################################################
 
-                try:
-                    _cmd    = cur[ self.prompt_line - 1 : cur_line ]        # whole line
-                    _cmd[0] = _cmd[0][ ( self.prompt_cursor - 1 ) : ]       # remove prompt, zero based slicing
+    def reattach( self ):
 
-                except:
-                    dbg_print( 'Error referencing the current buffer: ' + str( _cmd ) )
+        ##  The daemon closed our connection, either the shell went away or
+        ##  we fell too far behind ( see vimsh_daemon.queue ).  Attach again
+        ##  if it's still there and return the output we missed, None if
+        ##  it's gone.
 
-            if re.search( r'^\s*\bclear\b', _cmd[0] ) or re.search( r'^\s*\bcls\b', _cmd[0] ):
+        try:
+            names = [ string.split( line, '\t' )[ 0 ] for line in daemon_request( [ 'list' ] ) ]
 
-                dbg_print ( 'execute_cmd: clear detected' )
-                self.clear_screen( True )
+            if self.filename not in names:
+                return None
 
-            elif re.search( r'^\s*\exit\b', _cmd[0] ):
+            dbg_print( 'reattach: ' + self.filename + ' is still running' )
 
-                dbg_print ( 'execute_cmd: exit detected' )
-                self.handle_exit_cmd( _cmd )
+            self.sock.close()
 
-            else:
+            ##  The caller renders the tail, which counts it again
 
-                dbg_print ( 'execute_cmd: other command executed' )
+            tail = self.setup_daemon()
+            self.stream_offset -= len( tail )
 
-                for c in _cmd:
-                    if _null_terminate:
-                        self.write( c + '\n' )
+            return tail
 
-                    else:
-                        self.write( c )
+        except ( socket.error, IOError ):
+            return None
 
-                self.end_exe_line()
-                vim.command( 'startinsert!' )
+################################################################################
 
-            self.last_cmd_executed = _cmd[0]
+    def detach( self ):
 
-        except KeyboardInterrupt:
+        ##  Let go of the daemon's shell, it keeps running and collecting
+        ##  output until we attach again.
 
-            dbg_print( 'execute_cmd: in keyboard interrupt exception, sending SIGINT' )
+        if not self.daemon or self.detached:
+            return
 
-            self.keyboard_interrupt = 1
+        dbg_print( 'detach: enter' )
 
-            ##  TODO: Sending Ctrl-C isn't working on Windows yet, so
-            ##        executing something like 'findstr foo' will hang.
+        self.sock.close()
+        self.detached = 1
 
-            if not self.using_pty:
-                self.send_intr()
+        ##  The fd numbers get reused, nothing must write to them
 
-        except Exception, e:            
+        self.outd = None
+        self.ind  = None
+        self.errd = None
 
-            ##  Anything else is the shell exiting
+################################################################################
 
-            dbg_print( 'execute_cmd: exception' )
+    def no_shell( self ):
 
-            self.handle_shell_exited()
+        ##  Why there's no shell to talk to right now, '' if there is one
 
-            had_non_keyb_exception = 1
+        if self.replay:
+            return 'replay buffer, there\'s no shell'
 
-        if not had_non_keyb_exception and self.shell_exited:
-            self.handle_shell_exited()
+        if self.detached:
+            return 'detached, :VimShNewBuf ' + self.filename[ 1:-1 ] + ' attaches again'
+
+        return ''
 
 ################################################################################
 
-    def end_exe_line( self ):
+    def set_winsize( self, _rows, _cols ):
 
-        ##  read anything that's on stdout after a command is executed
+        ##  Tell the pty ( and so the programs on it ) how big the window
+        ##  is, they get a SIGWINCH if it changed.  Replay buffers have no
+        ##  pty to tell.
 
-        dbg_print( 'end_exe_line: enter' )
+        if not self.using_pty or self.pid == None or ( _rows, _cols ) == self.winsize:
+            return
 
-        cur = self.buffer
+        dbg_print( 'set_winsize: %d rows %d cols' % ( _rows, _cols ) )
 
-        cur.append( '' )
-        vim.command( 'normal G$' )
+        self.winsize = ( _rows, _cols )
 
-        self.read( cur )
-        self.check_for_passwd()
+        if self.daemon:
+            daemon_request( [ 'resize', self.filename, str( _rows ), str( _cols ) ] )
+
+        else:
+            set_pty_winsize( self.outd, _rows, _cols )
 
 ################################################################################
 
@@ -287,6 +359,16 @@ class vimsh:
 
         dbg_print( 'write: writing out --> ' + _cmd )
 
+        if self.replay or self.detached:
+            print 'vimsh: ' + self.no_shell()
+            return
+
+        if self.write_stages:
+            _cmd = string.join( list( self.run_stages( self.write_stages, [ _cmd ] ) ), '' )
+
+        if self.recorder:
+            self.record( 'w', _cmd )
+
         if self.using_pty:
             os.write( self.ind, _cmd )
 
@@ -296,10 +378,20 @@ class vimsh:
 
 ################################################################################
 
-    def read( self, _buffer ):
+    def read( self, _delay = None ):
 
         dbg_print( 'read: entered' )
 
+        if self.replay or self.detached:
+            self.sink.end_read( 0 )
+            return
+
+        ##  Caller can ask for a shorter timeout, i.e. a warm shell whose
+        ##  prompt is already waiting to be read
+
+        if _delay == None:
+            _delay = self.delay
+
         num_iterations       = 0      ##  counter for periodic redraw
         iters_before_redraw  = 10
         any_lines_read       = 0      ##  sentinel for reading anything at all
@@ -310,7 +402,7 @@ class vimsh:
         while 1:
 
             if self.using_pty:
-                r, w, e = select.select( [ self.outd ], [], [], self.delay )
+                r, w, e = select.select( [ self.outd ], [], [], _delay )
 
             else:
                 r = [1,]  ##  pipes, unused, fake it out so I don't have to special case
@@ -320,11 +412,33 @@ class vimsh:
                 lines = ''
 
                 if self.using_pty:
-                    lines = os.read( self.outd, 32 )
+
+                    try:
+                        lines = os.read( self.outd, self.read_size )
+
+                    except OSError:
+                        if not self.daemon:
+                            raise
+
+                        lines = ''          ##  ECONNRESET, daemon let go of us
 
                 else:
                     lines = self.pipe_read( self.outd, 2048 )
 
+                if lines == '' and self.daemon:
+
+                    ##  Readable but empty on the daemon socket, the shell
+                    ##  went away or we have to attach again
+
+                    lines = self.reattach()
+
+                    if lines == None:
+                        self.shell_exited = 1
+                        lines = ''
+
+                    elif lines == '':
+                        continue            ##  select on the new socket
+
                 if lines == '':
                     dbg_print( 'read: No more data on stdout pipe_read' )
 
@@ -334,22 +448,135 @@ class vimsh:
                 any_lines_read  = 1 
                 num_iterations += 1
 
-                lines = self.process_read( lines )
-                self.print_lines( lines, _buffer )
+                self.render_chunk( lines )
 
                 ##  Give vim a little cpu time, so programs that spit
                 ##  output or are long operations seem more responsive
 
                 if not num_iterations % iters_before_redraw:
                     dbg_print( 'read: Letting vim redraw' )
-                    vim.command( 'call VimShRedraw()' )
+                    self.sink.redraw()
 
             if r == []:
                 dbg_print( 'read: end of data to self.read()' )
-                self.end_read( any_lines_read )
+
+                self.end_chunks()
+                self.sink.end_read( any_lines_read )
 
                 break
 
+################################################################################
+
+    def render_chunk( self, _data ):
+
+        ##  Raw output from the pty to the buffer, shared by read and replay
+
+        self.stream_offset += len( _data )
+
+        if self.recorder:
+            self.record( 'r', _data )
+
+        if self.chunk_stages:
+            _data = string.join( list( self.run_stages( self.chunk_stages, [ _data ] ) ), '' )
+
+        lines = self.process_read( _data )
+
+        if self.line_stages:
+            lines = self.filter_lines( lines )
+
+        self.sink.print_lines( lines )
+
+################################################################################
+
+    def end_chunks( self ):
+
+        ##  Nothing more coming for now, a line held back from the line
+        ##  stages ( i.e. a prompt ) has to be shown as is
+
+        if self.partial:
+            self.sink.print_lines( [ self.partial ] )
+            self.partial = ''
+
+################################################################################
+
+    def filter_lines( self, _lines ):
+
+        ##  Line stages only ever see whole lines ( ending in '\r' ), the
+        ##  last piece of a read is held until the rest of it arrives
+
+        if self.partial:
+
+            if _lines:
+                _lines[ 0 ] = self.partial + _lines[ 0 ]
+
+            else:
+                _lines = [ self.partial ]
+
+            self.partial = ''
+
+        if self.using_pty and _lines and _lines[ -1 ][ -1: ] != '\r':
+            self.partial = _lines.pop()
+
+        return list( self.run_stages( self.line_stages, _lines ) )
+
+################################################################################
+
+    def run_stages( self, _stages, _items ):
+
+        ##  Chain the stages, each is a generator over the previous one
+
+        for stage in _stages:
+            _items = stage( self, _items )
+
+        return _items
+
+################################################################################
+
+    def enable_hook( self, _name, _enable = 1 ):
+
+        if _name not in _HOOKS_:
+            print 'vimsh: no hook named ' + _name
+            return
+
+        if _enable and _name not in self.hooks:
+            self.hooks.append( _name )
+
+        elif not _enable and _name in self.hooks:
+            self.hooks.remove( _name )
+
+        ##  Rebuild the stage lists in the order hooks were enabled
+
+        stages = { 'chunk' : [], 'line' : [], 'write' : [] }
+
+        for name in self.hooks:
+            kind, func, default = _HOOKS_[ name ]
+            stages[ kind ].append( func )
+
+        self.chunk_stages = stages[ 'chunk' ]
+        self.line_stages  = stages[ 'line' ]
+        self.write_stages = stages[ 'write' ]
+
+################################################################################
+
+    def toggle_hook( self, _name = '' ):
+
+        ##  :VimShHook [name]
+
+        if _name == '':
+
+            for name in sorted( _HOOKS_.keys() ):
+
+                state = 'off'
+
+                if name in self.hooks:
+                    state = 'on'
+
+                print '%-20s %-6s %s' % ( name, _HOOKS_[ name ][ 0 ], state )
+
+            return
+
+        self.enable_hook( _name, _name not in self.hooks )
+
 ################################################################################
 
     def process_read( self, _lines ):
@@ -388,527 +615,3528 @@ class vimsh:
 
 ################################################################################
 
-    def print_lines( self, _lines, _buffer ):
+    def sigchld_handler( self, _sig, _frame ):
 
-        num_lines = len( _lines )
+        dbg_print( 'sigchld_handler: caught SIGCHLD' )
 
-        dbg_print( 'print_lines: Number of lines to print--> ' + str( num_lines ) )
+        self.waitpid()
 
-        for line_iter in _lines:
+################################################################################
 
-            dbg_print( 'print_lines: Current line is --> %s' % line_iter )
+    def sigint_handler( self, _sig, _frame ):
 
-            m = None
+        dbg_print( 'sigint_handler: caught SIGINT' )
+        dbg_print( '' )
 
-            while re.search( '\r$', line_iter ):
+        self.waitpid()
 
-                dbg_print( 'print_lines: removing trailing ^M' )
+################################################################################
 
-                line_iter = line_iter[ :-1 ]   #  Force it
-                m = True
+    def waitpid( self ):
 
-            ##  Jump to the position of the last insertion to the buffer
-            ##  if it was a new line it should be 1, if it wasn't
-            ##  terminated by a '\n' it should be the end of the string
+        ##  This routine cannot do anything except for marking that the original
+        ##  shell process has gone away if it has.  This is due to the async
+        ##  nature of signals.
 
-            vim.command( 'normal ' + str( self.prompt_cursor ) + '|' )
+        try:
+            pid = os.waitpid( self.pid, os.WNOHANG )[0]
 
-            cur_line, cur_row = self.get_vim_cursor_pos()
-            dbg_print( 'print_lines: After jumping to end of last cmd: line %d row %d' % ( cur_line, cur_row ) )
+        except OSError:
+            pid = self.pid          ##  ECHILD, someone else reaped it
 
-            dbg_print( 'print_lines: Pasting ' + line_iter + ' to current line' )
-            _buffer[ cur_line - 1 ] += line_iter
+        if pid:
 
-            ##  If there's a '\n' or using pipes and it's not the last line
+            self.shell_exited = 1
+            dbg_print( 'waitpid: shell exited' )
+
+        else:
 
-            if not self.using_pty or m != None:
+            dbg_print( 'waitpid: shell hasn\'t exited, ignoring' )
 
-                dbg_print( 'print_lines: Appending new line since ^M or not using pty' )
-                _buffer.append( '' )
+################################################################################
 
-            vim.command( 'normal G$' )
-            vim.command( 'startinsert!' )
+    def record( self, _kind, _data ):
 
-            self.prompt_line, self.prompt_cursor = self.get_vim_cursor_pos()
-            dbg_print( 'print_lines: Saving cursor location: line %d row %d ' % ( self.prompt_line, self.prompt_cursor ) )
+        ##  Log format is a header line then for each read ( 'r' ) or write
+        ##  ( 'w' ): kind, seconds since recording started ( double ),
+        ##  length, all big endian, followed by the raw bytes
+
+        self.recorder.write( struct.pack( '>cdI', _kind, time.time() - self.record_start, len( _data ) ) + _data )
 
 ################################################################################
 
-    def end_read( self, _any_lines_read ):
+    def toggle_record( self, _filename = '' ):
 
-        cur_line, cur_row = self.get_vim_cursor_pos( )
+        ##  :VimShRecord [file]
 
-        if not self.using_pty and _any_lines_read:
+        if self.recorder:
 
-            ##  remove last line for last read only if lines were
-            ##  read from stdout.  TODO: any better way to do this?
+            self.recorder.close()
+            self.recorder = None
 
-            vim.command( 'normal dd' )
+            print 'vimsh: recording stopped'
+            return
 
-        vim.command( 'normal G$' )
-        vim.command( 'startinsert!' )
+        if _filename == '':
+            _filename = os.path.join( os.getcwd(), 'vimsh-%d.rec' % time.time() )
 
-        ##  Tuck away location, all data read is in buffer
+        self.recorder     = open( os.path.expanduser( _filename ), 'wb' )
+        self.record_start = time.time()
 
-        self.prompt_line, self.prompt_cursor = self.get_vim_cursor_pos()
-        dbg_print( 'end_read: Saving cursor location: line %d row %d ' % ( self.prompt_line, self.prompt_cursor ) )
+        self.recorder.write( record_magic )
+
+        print 'vimsh: recording to ' + _filename
 
 ################################################################################
 
-    def page_output( self, _add_new_line = 0 ):
+    def shell_cwd( self ):
 
-        dbg_print( 'page_output: enter' )
+        ##  Working directory of whatever is in the foreground on our pty
+        ##  ( the shell, or i.e. a python started from it ).  Falls back to
+        ##  vim's own where there's no /proc or no shell ( a replay ).
 
-        ##  read anything that's left on stdout
+        pid = self.pid
 
-        cur = self.buffer
+        if pid == None:
+            return os.getcwd()
 
-        if _add_new_line:
+        try:
 
-            cur.append( '' )
-            vim.command( 'normal G$' )
+            ##  tpgid is the 6th field after the ')' closing the command name
 
-        self.read( cur )
+            stat  = open( '/proc/%d/stat' % pid ).read()
+            tpgid = int( string.split( stat[ string.rfind( stat, ')' ) + 1: ] )[ 5 ] )
 
-        self.check_for_passwd()
+            if tpgid > 0 and os.path.exists( '/proc/%d/cwd' % tpgid ):
+                pid = tpgid
 
-        vim.command( 'startinsert!' )
+            return os.readlink( '/proc/%d/cwd' % pid )
+
+        except ( IOError, OSError, ValueError, IndexError ):
+            return os.getcwd()
 
 ################################################################################
 
-    def cleanup( self ):
+    def pipe_read( self, _pipe, _minimum_to_read ):
 
-        ##  NOTE: Only called via autocommand
+        ##  Hackaround since Windows doesn't support select() except for sockets.
 
-        dbg_print( 'cleanup: enter' )
+        dbg_print( 'pipe_read: minimum to read is ' + str( _minimum_to_read ) )
+        dbg_print( 'pipe_read: sleeping for ' + str( self.delay ) + ' seconds' )
 
-        ##  Remove autocommand so we don't get multiple calls
+        time.sleep( self.delay )
+
+        data  = ''
+        osfh  = msvcrt.get_osfhandle( _pipe )
+
+        ( read, count, msg ) = PeekNamedPipe( osfh, 0 )
+
+        dbg_print( 'pipe_read: initial count via PeekNamedPipe is ' + str( count ) )
+
+        while ( count > 0 ):
+
+            dbg_print( 'pipe_read: reading from pipe' )
+            dbg_print( '' )
+
+            ( err, tmp ) = ReadFile( osfh, count, None )
+            data += tmp
+
+            dbg_print( 'pipe_read: read ' + str( tmp ) )
+
+            ( read, count, msg ) = PeekNamedPipe( osfh, 0 )
+
+            ##  Be sure to break the read, if asked to do so,
+            ##  after we've read in a line termination.
+
+            if _minimum_to_read != 0 and len( data ) > 0 and data[ len( data ) -1 ] == '\n':
+
+                if len( data ) >= _minimum_to_read:
+                    dbg_print( 'pipe_read: found termination and read at least the minimum asked for' )
+                    break
+
+                else:
+                    dbg_print( 'pipe_read: not all of the data has been read' )
+
+        dbg_print( 'pipe_read: returning' )
+
+        return data
+
+################################################################################
+
+    def chk_stderr( self ):
+
+        errors  = ''
+        dbg_print( 'chk_stderr: enter' )
+
+        if not self.using_pty:
+
+            err_txt  = self.pipe_read( self.errd, 0 )
+            errors   = string.split( err_txt, '\n' )
+
+            num_lines = len( errors )
+            dbg_print( 'chk_stderr: Number of error lines is ' + `num_lines` )
+
+            last_line = errors[ num_lines - 1 ].strip()
+
+            if last_line == '':
+                dbg_print( 'chk_stderr: Removing last line, it\'s empty' )
+                errors = errors[ :-1 ]
+
+        return errors
+
+################################################################################
+##                             class vimsh                                    ##
+################################################################################
+
+class vimsh( vimsh_engine ):
+
+    ##  The engine plus a vim buffer, it's also the engine's output sink
+
+    def __init__( self, _sh, _arg, _filename ):
+
+        global _NEXT_SID_
+
+        vimsh_engine.__init__( self, _sh, _arg, _filename )
+
+        self.sink      = self
+
+        self.sid       = _NEXT_SID_     ##  unique for the life of vim
+        _NEXT_SID_    += 1
+
+        self.prompt_line, self.prompt_cursor = self.get_vim_cursor_pos()
+
+        self.password_regex   = password_regex      ##  compiled, see customization
+        self.any_read         = 0                   ##  last read got something
+
+        self.buffer                = vim.current.buffer
+
+        self.recall_text           = None   ##  what history_recall last put on the prompt
+        self.recall_prefix         = ''
+        self.recall_stack          = []
+
+        ##  Where each command's output is in the buffer, see begin_output.
+        ##  Line numbers are absolute, buffer line + lines evicted from the
+        ##  top, so they stay valid when old lines are thrown away.
+
+        self.outputs               = []
+        self.output_starts         = []     ##  start of each, for bisect
+        self.evicted               = 0
+
+        ##  Compiler/test errors go to the quickfix list as they're printed
+
+        self.errors_on             = ( errors_default == '1' )
+        self.pending_errors        = []
+        self.errors_new            = 0      ##  next flush starts a new list
+
+        ##  Runs of the same line are shown once plus a counter, see
+        ##  compact_line
+
+        self.compact_on            = ( compact_default == '1' )
+        self.compact_key           = None   ##  last finished line, masked
+        self.compact_count         = 0
+        self.compact_next          = 0      ##  where a repeat of it would be
+
+        ##  Raw mode, keys typed and seconds from each key to its echo
+        ##  being on screen
+
+        self.raw_on                = 0
+        self.raw_keys              = 0
+        self.key_latency           = []
+
+################################################################################
+
+    def execute_cmd( self, _cmd = None, _null_terminate = 1 ):
+
+        had_non_keyb_exception = 0
+
+        dbg_print ( 'execute_cmd: Entered cmd is ' + str( _cmd ) )
+
+        ##  Only commands typed at the prompt go in the history, not
+        ##  passwords or the empty one new_prompt sends
+
+        typed = ( _cmd == None )
+
+        if self.replay or self.detached:
+            print 'vimsh: ' + self.no_shell()
+            vim.command( 'startinsert!' )
+            return
+
+        ##  :resize, <C-w> and the mouse don't fire any autocmd vimsh can
+        ##  use, so catch up here.  Nothing is sent if the size is the same.
+
+        self.sync_winsize()
+
+        if self.keyboard_interrupt:
+
+            dbg_print( 'execute_cmd: keyboard interrupt earlier, cleaning up' )
+
+            self.page_output( 1 )
+            self.keyboard_interrupt = 0
+
+            return
+
+        ##  This is the main worker function
+
+        try:
+
+            print ''            ##  Clears the ex command window
+
+            cur = self.buffer
+            cur_line, cur_row = self.get_vim_cursor_pos()
+
+            if _cmd == None:
+
+                ##  Grab everything from the prompt to the current cursor position.
+
+                try:
+                    _cmd    = cur[ self.prompt_line - 1 : cur_line ]        # whole line
+                    _cmd[0] = _cmd[0][ ( self.prompt_cursor - 1 ) : ]       # remove prompt, zero based slicing
+
+                except:
+                    dbg_print( 'Error referencing the current buffer: ' + str( _cmd ) )
+
+            ##  Commands vimsh handles itself, by first word
+
+            builtin = builtin_word.match( _cmd[0] )
+
+            if builtin:
+                builtin = builtin_cmds.get( builtin.group( 1 ) )
+
+            if builtin:
+
+                dbg_print ( 'execute_cmd: builtin ' + builtin + ' detected' )
+                getattr( self, builtin )( _cmd )
+
+            else:
+
+                dbg_print ( 'execute_cmd: other command executed' )
+
+                if typed:
+                    self.begin_output( _cmd )
+
+                    self.errors_new = 1     ##  new list at the first error
+
+                for c in _cmd:
+                    if _null_terminate:
+                        self.write( c + '\n' )
+
+                    else:
+                        self.write( c )
+
+                self.end_exe_line()
+                vim.command( 'startinsert!' )
+
+            self.last_cmd_executed = _cmd[0]
+            self.recall_text       = None
+
+            if typed:
+                add_history( string.join( _cmd, '\n' ) )
+
+        except KeyboardInterrupt:
+
+            dbg_print( 'execute_cmd: in keyboard interrupt exception, sending SIGINT' )
+
+            self.keyboard_interrupt = 1
+
+            ##  TODO: Sending Ctrl-C isn't working on Windows yet, so
+            ##        executing something like 'findstr foo' will hang.
+
+            if not self.using_pty:
+                self.send_intr()
+
+        except Exception, e:            
+
+            ##  Anything else is the shell exiting
+
+            dbg_print( 'execute_cmd: exception' )
+
+            self.handle_shell_exited()
+
+            had_non_keyb_exception = 1
+
+        if not had_non_keyb_exception and self.shell_exited:
+            self.handle_shell_exited()
+
+################################################################################
+
+    def end_exe_line( self ):
+
+        ##  read anything that's on stdout after a command is executed
+
+        dbg_print( 'end_exe_line: enter' )
+
+        cur = self.buffer
+
+        cur.append( '' )
+        vim.command( 'normal G$' )
+
+        self.read()
+        self.check_for_passwd()
+
+################################################################################
+
+    def print_lines( self, _lines ):
+
+        _buffer   = self.buffer
+        num_lines = len( _lines )
+
+        dbg_print( 'print_lines: Number of lines to print--> ' + str( num_lines ) )
+
+        for line_iter in _lines:
+
+            dbg_print( 'print_lines: Current line is --> %s' % line_iter )
+
+            m = None
+
+            while re.search( '\r$', line_iter ):
+
+                dbg_print( 'print_lines: removing trailing ^M' )
+
+                line_iter = line_iter[ :-1 ]   #  Force it
+                m = True
+
+            ##  Jump to the position of the last insertion to the buffer
+            ##  if it was a new line it should be 1, if it wasn't
+            ##  terminated by a '\n' it should be the end of the string
+
+            vim.command( 'normal ' + str( self.prompt_cursor ) + '|' )
+
+            cur_line, cur_row = self.get_vim_cursor_pos()
+            dbg_print( 'print_lines: After jumping to end of last cmd: line %d row %d' % ( cur_line, cur_row ) )
+
+            ##  If there's a '\n' or using pipes and it's not the last line
+
+            done = ( not self.using_pty or m != None )
+
+            ##  A repeated line is never pasted, only its counter changes
+
+            if done and self.compact_on and self.compact_line( cur_line, _buffer[ cur_line - 1 ] + line_iter ):
+
+                dbg_print( 'print_lines: repeated line, counter updated' )
+
+            else:
+
+                dbg_print( 'print_lines: Pasting ' + line_iter + ' to current line' )
+                _buffer[ cur_line - 1 ] += line_iter
+
+                if done:
+
+                    self.line_done( cur_line, _buffer[ cur_line - 1 ] )
+
+                    dbg_print( 'print_lines: Appending new line since ^M or not using pty' )
+                    _buffer.append( '' )
+
+            vim.command( 'normal G$' )
+            vim.command( 'startinsert!' )
+
+            self.prompt_line, self.prompt_cursor = self.get_vim_cursor_pos()
+            dbg_print( 'print_lines: Saving cursor location: line %d row %d ' % ( self.prompt_line, self.prompt_cursor ) )
+
+################################################################################
+
+    def compact_line( self, _line, _text ):
+
+        ##  Called with the finished text of _line before it's pasted.  If
+        ##  it's the same as the line before ( after compact_mask ) it's
+        ##  folded into a counter line under the first one and 1 is
+        ##  returned, the counter is rewritten in place for each repeat
+        ##  after that.  0 means paste it as usual.
+
+        key = _text
+
+        if compact_mask:
+            key = compact_mask.sub( '#', _text )
+
+        if key != self.compact_key or _line != self.compact_next:
+
+            self.compact_key   = key
+            self.compact_count = 1
+            self.compact_next  = _line + 1
+
+            return 0
+
+        self.compact_count += 1
+
+        counter = compact_counter % self.compact_count
+
+        if self.compact_count == 2:
+
+            ##  This line turns into the counter
+
+            dbg_print( 'compact_line: repeat of line ' + str( _line - 1 ) )
+
+            self.buffer[ _line - 1 ] = counter
+            self.buffer.append( '' )
+
+            self.compact_next = _line + 1
+
+        else:
+
+            self.buffer[ _line - 2 ] = counter
+            self.buffer[ _line - 1 ] = ''
+
+        return 1
+
+################################################################################
+
+    def toggle_compact( self ):
+
+        self.compact_on  = not self.compact_on
+        self.compact_key = None
+
+        if self.compact_on:
+            print 'vimsh: compacting repeated lines'
+
+        else:
+            print 'vimsh: not compacting repeated lines'
+
+################################################################################
+
+    def redraw( self ):
+
+        if self.pending_errors:
+            self.flush_errors()
+
+        vim.command( 'call VimShRedraw()' )
+
+################################################################################
+
+    def print_bulk( self, _data ):
+
+        ##  Dump a big chunk of output ( daemon replay ) into the buffer in a
+        ##  single operation instead of a line at a time.
+
+        lines = string.split( string.replace( _data, '\r', '' ), '\n' )
+
+        cur   = self.buffer
+        first = len( cur )
+
+        cur[ -1 ] = cur[ -1 ] + lines[ 0 ]
+
+        if len( lines ) > 1:
+            cur.append( lines[ 1: ] )
+
+        for i in range( len( lines ) - 1 ):
+            self.line_done( first + i, cur[ first + i - 1 ] )
+
+        self.end_read( 1 )
+
+################################################################################
+
+    def line_done( self, _line, _text ):
+
+        ##  Every complete line of output passes through here once, right
+        ##  after it's been put in the buffer at line _line
+
+        if _INDEX_:
+            _INDEX_.add( self.sid, _line + self.evicted, _text )
+
+        if self.errors_on:
+
+            for regex in error_regex:
+
+                m = regex.match( _text )
+
+                if m:
+                    self.pending_errors.append( ( m, _line, _text ) )
+                    break
+
+################################################################################
+
+    def end_read( self, _any_lines_read ):
+
+        cur_line, cur_row = self.get_vim_cursor_pos( )
+
+        self.any_read = _any_lines_read
+
+        if not self.using_pty and _any_lines_read:
+
+            ##  remove last line for last read only if lines were
+            ##  read from stdout.  TODO: any better way to do this?
+
+            vim.command( 'normal dd' )
+
+        vim.command( 'normal G$' )
+        vim.command( 'startinsert!' )
+
+        ##  Tuck away location, all data read is in buffer
+
+        self.prompt_line, self.prompt_cursor = self.get_vim_cursor_pos()
+        dbg_print( 'end_read: Saving cursor location: line %d row %d ' % ( self.prompt_line, self.prompt_cursor ) )
+
+        if self.pending_errors:
+            self.flush_errors()
+
+        self.end_output()
+
+################################################################################
+
+    def end_output( self ):
+
+        ##  Whatever was read belongs to the last command, it ends just
+        ##  before the new prompt
+
+        if self.outputs:
+
+            last = self.outputs[ -1 ]
+
+            last[ 'end' ]   = self.prompt_line - 1 + self.evicted
+            last[ 'bytes' ] = self.stream_offset - last[ 'offset' ]
+
+################################################################################
+
+    def append_output( self, _cmd, _lines, _partial, _offset ):
+
+        ##  Output of _cmd that was read somewhere else ( broadcast ), put
+        ##  in the buffer as if _cmd had been typed at the prompt here
+
+        cur = self.buffer
+
+        cur[ self.prompt_line - 1 ] = cur[ self.prompt_line - 1 ][ :self.prompt_cursor ] + _cmd
+        del cur[ self.prompt_line: ]
+
+        self.begin_output( [ _cmd ] )
+        self.outputs[ -1 ][ 'offset' ] = _offset        ##  where the stream was before the read
+
+        first = len( cur ) + 1
+        cur.append( _lines + [ _partial ] )
+
+        for i in range( len( _lines ) ):
+            self.line_done( first + i, _lines[ i ] )
+
+        if self.pending_errors:
+            self.flush_errors()
+
+        self.prompt_line   = len( cur )
+        self.prompt_cursor = max( len( _partial ), 1 )
+
+        self.end_output()
+
+################################################################################
+
+    def page_output( self, _add_new_line = 0 ):
+
+        dbg_print( 'page_output: enter' )
+
+        if self.replay or self.detached:
+            vim.command( 'startinsert!' )
+            return
+
+        self.sync_winsize()             ##  see execute_cmd
+
+        ##  read anything that's left on stdout
+
+        cur = self.buffer
+
+        if _add_new_line:
+
+            cur.append( '' )
+            vim.command( 'normal G$' )
+
+        self.read()
+
+        self.check_for_passwd()
+
+        vim.command( 'startinsert!' )
+
+################################################################################
+
+    def cleanup( self ):
+
+        ##  NOTE: Only called via autocommand
+
+        dbg_print( 'cleanup: enter' )
+
+        ##  Remove autocommand so we don't get multiple calls
+
+        vim.command( 'au! BufDelete ' + self.filename )
+
+        remove_buf( self.filename )
+
+        if self.daemon:
+
+            ##  Shell belongs to the daemon, it outlives the buffer
+
+            self.detach()
+            return
+
+        try:
+
+            if self.using_pty:
+                os.kill( self.pid, signal.SIGKILL )
+
+        except:
+            dbg_print( 'cleanup: Exception, process probably already killed' )
+
+################################################################################
+
+    def send_intr( self ):
+
+        dbg_print( 'send_intr: enter' )
+
+        if self.replay or self.detached:
+            return
+
+        if show_workaround_msgs == '1':
+            print 'If you do NOT see a prompt in the vimsh buffer, press F5 or go into insert mode and press Enter'
+            print 'If you need a new prompt press F4'
+            print 'NOTE: To disable this help message set \'g:vimsh_show_workaround_msgs\' to 0 in your .vimrc'
+
+        ##  This triggers another KeyboardInterrupt async
+
+        try:
+
+            dbg_print( 'send_intr: writing intr_key' )
+
+            if self.using_pty:
+                os.kill( self.pid, signal.SIGINT )
+
+            ##  TODO: For this to work, I need to use CreateProcess or subprocess module
+            #else:
+            #    handle = OpenProcess( win32con.PROCESS_ALL_ACCESS, 0, self.pid )
+            #    GenerateConsoleCtrlEvent( win32con.CTRL_C_EVENT, handle )
+
+            #self.write( self.intr_key )
+
+            self.page_output( 1 )
+
+        except KeyboardInterrupt:
+
+            dbg_print( 'send_intr: caught KeyboardInterrupt in send_intr' )
+            pass
+
+################################################################################
+
+    def send_eof( self ):
+
+        dbg_print( 'send_eof: enter' )
+
+        if self.replay or self.detached:
+            print 'vimsh: ' + self.no_shell()
+            return
+
+        try:     ##  could cause shell to exit
+
+            self.write( self.eof_key )
+            self.page_output( 1 )
+
+        except Exception, e:        
+
+            dbg_print( 'send_eof: exception' )
+
+            self.handle_shell_exited()
+
+################################################################################
+
+    def handle_clear_cmd( self, _cmd ):
+
+        self.clear_screen( True )
+
+################################################################################
+
+    def handle_exit_cmd( self, _cmd ):
+
+        ##  Exit was typed, could be the spawned shell, or a subprocess like
+        ##  telnet/ssh/etc.
+
+        dbg_print( 'handle_exit_cmd: enter' )
+
+        dbg_print ( 'handle_exit_cmd: writing exit command' )
+        self.write( _cmd[0] + '\n' )
+
+        self.end_exe_line()
+        vim.command( 'startinsert!' )
+
+################################################################################
+
+    def handle_shell_exited( self ):
+
+        dbg_print( 'handle_shell_exited: enter' )
+
+        ##  when exiting this way can't have the autocommand
+        ##  for BufDelete run.  It crashes vim.  TODO:  Figure this out.
+
+        vim.command( 'stopinsert' )
+        vim.command( 'au! BufDelete ' + self.filename )
+        vim.command( 'bdelete! ' + self.filename )
+
+        remove_buf( self.filename )
+
+        if self.daemon:
+            self.detach()
+
+################################################################################
+
+    def set_timeout( self ):
+
+        timeout_ok = 0
+
+        while not timeout_ok:
+
+            try:
+                vim.command( 'let timeout = input( "Enter new timeout in seconds (i.e. 0.1), currently set to ' + str( self.delay ) + ' :  " )' )
+
+            except KeyboardInterrupt:
+                return
+
+            timeout = vim.eval( 'timeout' )
+
+            if timeout == '':               ##  usr cancelled dialog, break out
+                timeout_ok = 1
+
+            else:
+                timeout = float( timeout )
+            
+                if timeout >= 0.1:
+                    print '      --->   New timeout is ' + str( timeout ) + ' seconds'
+                    self.delay = timeout
+                    timeout_ok = 1
+
+################################################################################
+
+    def clear_screen( self, _in_insert_mode ):
+
+        dbg_print( 'clear_screen: insert mode is ' + str( _in_insert_mode )  )
+
+        self.write( '' + '\n' )    ##  new prompt
+
+        if clear_all == '1':
+            self.evict_lines( len( self.buffer ) )
+
+        self.end_exe_line()
+
+        if clear_all == '0':
+            vim.command( 'normal zt' )
+
+        if _in_insert_mode:
+            vim.command( 'startinsert!' )
+
+        else:
+            vim.command( 'stopinsert' )
+
+################################################################################
+
+    def new_prompt( self ):
+
+        self.execute_cmd( [''] )        #  just press enter
+
+        vim.command( 'normal G$' )
+        vim.command( 'startinsert!' )
+
+################################################################################
+
+    def history_recall( self, _older ):
+
+        ##  Walk the history for commands starting with whatever was typed
+        ##  at the prompt, older or newer, like most shells' up/down arrows.
+
+        hist = get_history()
+
+        if hist == None:
+            vim.command( 'startinsert!' )
+            return
+
+        cur  = self.buffer
+        head = cur[ self.prompt_line - 1 ][ :self.prompt_cursor ]
+        text = string.join( cur[ self.prompt_line - 1: ], '\n' )[ self.prompt_cursor: ]
+
+        if text != self.recall_text:
+
+            ##  User typed something since the last recall, start over
+
+            self.recall_prefix = text
+            self.recall_stack  = []
+
+        if _older:
+
+            seen   = [ cmd for idx, cmd in self.recall_stack ]
+            before = sys.maxint
+
+            if self.recall_stack:
+                before = self.recall_stack[ -1 ][ 0 ]
+
+            found = hist.prefix_before( self.recall_prefix, before, seen )
+
+            if found != None:
+                self.recall_stack.append( found )
+
+        elif self.recall_stack:
+            self.recall_stack.pop()
+
+        if self.recall_stack:
+            text = self.recall_stack[ -1 ][ 1 ]
+
+        else:
+            text = self.recall_prefix
+
+        self.put_cmd( head, text )
+
+################################################################################
+
+    def put_cmd( self, _head, _text ):
+
+        ##  Replace everything after the prompt with _text
+
+        self.recall_text = _text
+
+        lines      = string.split( _text, '\n' )
+        lines[ 0 ] = _head + lines[ 0 ]
+
+        self.buffer[ self.prompt_line - 1: ] = lines
+
+        vim.command( 'normal G$' )
+        vim.command( 'startinsert!' )
+
+################################################################################
+
+    def begin_output( self, _cmd ):
+
+        ##  Output starts on the line end_exe_line is about to add
+
+        start = len( self.buffer ) + 1 + self.evicted
+
+        self.outputs.append( { 'cmd'    : string.strip( string.join( _cmd, '\n' ) ),
+                               'start'  : start,
+                               'end'    : start - 1,
+                               'time'   : time.time(),
+                               'offset' : self.stream_offset,
+                               'bytes'  : 0 } )
+
+        self.output_starts.append( start )
+
+        self.compact_key = None     ##  don't fold into the last command's output
+
+################################################################################
+
+    def evict_lines( self, _count ):
+
+        ##  Throw away the first _count lines of the buffer and forget any
+        ##  outputs that were entirely in them, after putting them in the
+        ##  archive
+
+        first = bisect.bisect_left( [ o[ 'end' ] for o in self.outputs ], self.evicted + _count + 1 )
+
+        if _ARCHIVE_:
+
+            for o in self.outputs[ :first ]:
+
+                lines = self.buffer[ o[ 'start' ] - self.evicted - 1 : o[ 'end' ] - self.evicted ]
+
+                if lines:
+                    _ARCHIVE_.add( self.filename, o[ 'cmd' ], o[ 'time' ], lines )
+
+        if _count >= len( self.buffer ):
+            vim.command( 'normal ggdG' )
+
+        else:
+            del self.buffer[ :_count ]
+
+        self.evicted += _count
+
+        self.compact_key = None
+
+        if _INDEX_:
+            _INDEX_.dead += _count
+
+        if first:
+            del self.outputs[ :first ]
+            del self.output_starts[ :first ]
+
+################################################################################
+
+    def output_at( self, _line ):
+
+        ##  Index of the output that starts at or before buffer line _line
+
+        return bisect.bisect_right( self.output_starts, _line + self.evicted ) - 1
+
+################################################################################
+
+    def jump_output( self, _forward ):
+
+        cur_line = vim.current.window.cursor[ 0 ]
+        idx      = self.output_at( cur_line )
+
+        if _forward:
+            idx = idx + 1
+
+        elif idx >= 0 and self.output_starts[ idx ] == cur_line + self.evicted:
+            idx = idx - 1           ##  already at the start of this one
+
+        if idx < 0 or idx >= len( self.outputs ):
+            print 'vimsh: no more command output'
+            return
+
+        vim.current.window.cursor = ( self.outputs[ idx ][ 'start' ] - self.evicted, 0 )
+
+################################################################################
+
+    def fold_outputs( self ):
+
+        vim.command( 'setlocal foldmethod=manual' )
+        vim.command( 'normal zE' )
+
+        for o in self.outputs:
+
+            if o[ 'end' ] >= o[ 'start' ]:
+                vim.command( '%d,%dfold' % ( o[ 'start' ] - self.evicted, o[ 'end' ] - self.evicted ) )
+
+################################################################################
+
+    def yank_output( self, _nth = 1 ):
+
+        ##  Yank the output of the _nth from last command into the unnamed
+        ##  register
+
+        if _nth < 1 or _nth > len( self.outputs ):
+            print 'vimsh: no such command output'
+            return
+
+        o = self.outputs[ -_nth ]
+
+        if o[ 'end' ] < o[ 'start' ]:
+            print 'vimsh: \'' + o[ 'cmd' ] + '\' had no output'
+            return
+
+        vim.command( '%d,%dyank' % ( o[ 'start' ] - self.evicted, o[ 'end' ] - self.evicted ) )
+
+        print 'vimsh: yanked output of \'' + o[ 'cmd' ] + '\''
+
+################################################################################
+
+    def flush_errors( self ):
+
+        ##  Add the errors found since the last flush to the list.  Files
+        ##  are relative to the shell's directory, if one can't be found
+        ##  the entry points at the line in the vimsh buffer instead, as
+        ##  long as it says it's an error ( not a timestamp, host:port ).
+
+        cwd     = self.shell_cwd()
+        entries = []
+
+        for m, line, line_text in self.pending_errors:
+
+            groups = m.groupdict()
+            path   = os.path.join( cwd, os.path.expanduser( groups[ 'file' ] ) )
+            text   = string.strip( groups.get( 'text' ) or line_text )
+
+            kind = 'E'
+
+            if re.search( r'(?i)\bwarning\b', text ):
+                kind = 'W'
+
+            if os.path.isfile( path ):
+                loc = '"filename" : %s, "lnum" : %s, "col" : %s' % ( vim_str( path ), groups[ 'line' ], groups.get( 'col' ) or '0' )
+
+            elif error_word.search( line_text ):
+                loc = '"bufnr" : %d, "lnum" : %d' % ( self.buffer.number, line )
+
+            else:
+                continue
+
+            entries.append( '{ %s, "text" : %s, "type" : "%s" }' % ( loc, vim_str( text ), kind ) )
+
+        self.pending_errors = []
+
+        if not entries:
+            return
+
+        if self.errors_new:
+            self.set_error_list( entries, ' ' )
+            self.errors_new = 0
+
+        else:
+            self.set_error_list( entries, 'a' )
+
+################################################################################
+
+    def set_error_list( self, _entries, _action ):
+
+        entries = '[ ' + string.join( _entries, ', ' ) + ' ]'
+
+        if errors_list == 'location':
+            vim.command( 'call setloclist( bufwinnr( %d ), %s, "%s" )' % ( self.buffer.number, entries, _action ) )
+
+        else:
+            vim.command( 'call setqflist( %s, "%s" )' % ( entries, _action ) )
+
+################################################################################
+
+    def toggle_errors( self ):
+
+        self.errors_on = not self.errors_on
+
+        if self.errors_on:
+            print 'vimsh: collecting errors into the ' + errors_list + ' list'
+
+        else:
+            print 'vimsh: not collecting errors'
+
+################################################################################
+
+    def raw_mode( self ):
+
+        ##  :VimShRaw, send each key to the shell as it's typed instead of a
+        ##  line at a time on <CR>, for REPLs and y/n prompts.  Vim is busy
+        ##  in this loop until raw_exit_key is typed or the shell exits.
+
+        if not self.using_pty or self.replay or self.detached:
+            print 'vimsh: raw mode needs a pty'
+            return
+
+        ##  The shell's pty has echo and line editing off since vimsh
+        ##  normally does both, turn them back on while keys go straight
+        ##  through.  Not possible through the daemon's socket.
+
+        saved = None
+
+        if not self.daemon:
+
+            try:
+                saved   = tty.tcgetattr( self.outd )
+                cooked  = saved[ : ]
+
+                cooked[ 0 ] = cooked[ 0 ] | tty.ICRNL           ##  <CR> ends the line
+                cooked[ 3 ] = cooked[ 3 ] | tty.ICANON | tty.ECHO
+                tty.tcsetattr( self.outd, tty.TCSANOW, cooked )
+
+            except tty.error:
+                saved = None
+
+        ##  Wake up for keys as well as output when vim reads from a
+        ##  terminal, otherwise poll for them
+
+        fds = [ self.outd ]
+
+        if vim.eval( 'has( "gui_running" )' ) == '0':
+            fds.append( 0 )
+
+        sent = None         ##  when the oldest key not yet echoed was sent
+
+        self.raw_on = 1
+
+        print 'vimsh: raw mode, type ' + raw_exit_name + ' to leave'
+        vim.command( 'redraw' )
+
+        try:
+
+            while not self.shell_exited:
+
+                try:
+                    key = vim.eval( 'getchar( 0 )' )
+
+                except KeyboardInterrupt:
+                    key = '3'                       ##  ^C
+
+                if key != '0':
+
+                    if key == raw_exit_key:
+                        break
+
+                    data = raw_key_bytes( key )
+
+                    if data:
+
+                        if sent == None:
+                            sent = time.time()
+
+                        self.write( data )
+                        self.raw_keys += 1
+
+                r, w, e = select.select( fds, [], [], raw_poll )
+
+                if self.outd not in r:
+                    continue
+
+                try:
+                    data = os.read( self.outd, 65536 )
+
+                except OSError:
+                    data = ''               ##  EIO, shell exited
+
+                if data == '' and self.daemon:
+
+                    tail = self.reattach()
+
+                    if tail != None:
+
+                        fds[ 0 ] = self.outd
+
+                        if tail == '':
+                            continue
+
+                        data = tail
+
+                if data == '':
+                    self.shell_exited = 1
+                    break
+
+                self.raw_render( data )
+                vim.command( 'redraw' )
+
+                ##  After the redraw, that's when the echo can be seen
+
+                if sent != None:
+
+                    self.key_latency.append( time.time() - sent )
+                    sent = None
+
+                    if len( self.key_latency ) > 1000:
+                        del self.key_latency[ :-1000 ]
+
+        finally:
+
+            self.raw_on = 0
+
+            if saved:
+                tty.tcsetattr( self.outd, tty.TCSANOW, saved )
+
+        if self.shell_exited:
+            self.handle_shell_exited()
+
+        else:
+            print 'vimsh: left raw mode'
+
+################################################################################
+
+    def raw_render( self, _data ):
+
+        ##  Echo of what was typed, backspace takes the last character
+        ##  off the line instead of showing up as ^H
+
+        pieces = string.split( _data, '\b' )
+
+        self.render_chunk( pieces[ 0 ] )
+
+        for piece in pieces[ 1: ]:
+
+            self.end_chunks()
+            self.buffer[ -1 ] = self.buffer[ -1 ][ :-1 ]
+
+            if piece:
+                self.render_chunk( piece )
+
+        self.end_chunks()
+        self.end_read( 1 )
+
+################################################################################
+
+    def sync_winsize( self ):
+
+        ##  Size of the window showing this buffer, if there is one
+
+        win = vim.eval( 'bufwinnr( ' + str( self.buffer.number ) + ' )' )
+
+        if win == '-1':
+            return
+
+        self.set_winsize( int( vim.eval( 'winheight( ' + win + ' )' ) ),
+                          int( vim.eval( 'winwidth( ' + win + ' )' ) ) )
+
+################################################################################
+
+    def get_vim_cursor_pos( self ):
+
+        cur_line, cur_row = vim.current.window.cursor
+        
+        return cur_line, cur_row + 1
+
+################################################################################
+
+    def check_for_passwd( self ):
+
+        ##  A password prompt is what was just read, the end of the line
+        ##  the cursor is left on.  Nothing new, nothing to look at.
+
+        if not self.any_read:
+            return
+
+        cur_line, cur_row = self.get_vim_cursor_pos()
+
+        tail = self.buffer[ cur_line - 1 ][ -password_tail: ]
+
+        if self.password_regex.search( tail ):
+
+            try:
+                vim.command( 'let password = inputsecret( "Password? " )' )
+
+            except KeyboardInterrupt:
+                return
+
+            password = vim.eval( 'password' )
+
+            self.execute_cmd( [password] )       ##  recursive call here...
+
+################################################################################
+##                          class vimsh_memory_sink                           ##
+################################################################################
+
+class vimsh_memory_sink:
+
+    ##  Output sink that keeps complete lines in a list, and also writes
+    ##  them to _file ( an open file ) if given.
+
+    def __init__( self, _file = None ):
+
+        self.lines   = []
+        self.partial = ''           ##  start of a line still being printed
+        self.file    = _file
+
+################################################################################
+
+    def print_lines( self, _lines ):
+
+        ##  Every piece but the last was followed by a '\n', the last one
+        ##  finishes a line only if it ends in '\r' ( pty )
+
+        last = len( _lines ) - 1
+
+        for i in range( len( _lines ) ):
+
+            piece = _lines[ i ]
+
+            if i == last and piece[ -1: ] != '\r':
+                self.partial += piece
+                continue
+
+            line = self.partial + string.rstrip( piece, '\r' )
+            self.partial = ''
+
+            self.lines.append( line )
+
+            if self.file:
+                self.file.write( line + '\n' )
+
+################################################################################
+
+    def end_read( self, _any_lines_read ):
+
+        if self.file:
+            self.file.flush()
+
+################################################################################
+
+    def redraw( self ):
+        pass
+
+################################################################################
+
+    def take( self ):
+
+        ##  Lines collected since the last take
+
+        lines      = self.lines
+        self.lines = []
+
+        return lines
+
+################################################################################
+##                          class vimsh_headless                              ##
+################################################################################
+
+class vimsh_headless( vimsh_engine ):
+
+    ##  A shell driven from plain python, no vim involved:
+    ##
+    ##      import vimsh
+    ##
+    ##      shell = vimsh.vimsh_headless()
+    ##      print shell.run( 'make' )
+    ##      shell.close()
+    ##
+    ##  Output is read in big chunks and run() returns as soon as the prompt
+    ##  is back instead of waiting out a read timeout.  Without a known
+    ##  prompt ( g:vimsh_pty_prompt_override off, or an rc file that sets
+    ##  its own PS1 ) it returns once the shell has been quiet for delay
+    ##  seconds like vim does.
+
+    def __init__( self, _sh = None, _arg = None, _sink = None, _prompt = None ):
+
+        if _sh == None:
+            _sh = sh
+
+        if _arg == None:
+            _arg = arg
+
+        vimsh_engine.__init__( self, _sh, _arg )
+
+        if _sink == None:
+            _sink = vimsh_memory_sink()
+
+        if _prompt == None and use_pty and prompt_override:
+            _prompt = new_prompt
+
+        self.sink      = _sink
+        self.prompt    = _prompt
+        self.read_size = 65536
+
+        self.setup_pty( use_pty, None, 0 )
+        self.wait()
+
+################################################################################
+
+    def run( self, _cmd, _timeout = 30 ):
+
+        ##  Run _cmd in the shell and return its output lines
+
+        self.sink.take()
+        self.sink.partial = ''          ##  the last prompt
+
+        self.write( _cmd + '\n' )
+        self.wait( _timeout )
+
+        lines = self.sink.take()
+
+        ##  Output that didn't end in a newline is in front of the prompt
+
+        rest = self.sink.partial
+
+        if self.prompt and rest[ -len( self.prompt ): ] == self.prompt and len( rest ) > len( self.prompt ):
+            lines.append( rest[ :-len( self.prompt ) ] )
+
+        return lines
+
+################################################################################
+
+    def wait( self, _timeout = 30 ):
+
+        ##  Read until the prompt shows up again, nothing comes for delay
+        ##  seconds, _timeout passes or the shell goes away
+
+        if not self.prompt or not self.using_pty:
+            self.read()
+            return
+
+        end = time.time() + _timeout
+
+        while not self.shell_exited:
+
+            left = end - time.time()
+
+            if left <= 0:
+                break
+
+            r, w, e = select.select( [ self.outd ], [], [], min( left, self.delay ) )
+
+            if not r:
+                break
+
+            try:
+                data = os.read( self.outd, self.read_size )
+
+            except OSError:
+                data = ''               ##  EIO, shell exited
+
+            if data == '':
+                self.waitpid()              ##  no SIGCHLD handler, reap it here
+                self.shell_exited = 1
+                break
+
+            self.render_chunk( data )
+
+            if ( self.sink.partial + self.partial )[ -len( self.prompt ): ] == self.prompt:
+                break
+
+        self.end_chunks()
+        self.sink.end_read( 1 )
+
+################################################################################
+
+    def close( self ):
+
+        if self.using_pty:
+            kill_pty( self.pid, self.fd )
+
+################################################################################
+##                          class vimsh_daemon                                ##
+################################################################################
+
+class vimsh_daemon:
+
+    ##  Runs in its own process ( see start_daemon ), owns the ptys and keeps
+    ##  the tail of each shell's output.  A vim attaching to a shell is
+    ##  handed everything after the offset it asks for in one reply, after
+    ##  that the connection is a plain stream to and from the pty.
+    ##
+    ##  Requests are a single line of tab separated fields:
+    ##
+    ##      attach <name> <sh> <arg> <offset>  ->  ok <pid> <start> <len>, data
+    ##      list                               ->  <name> <pid> <offset> ...
+    ##      kill <name>                        ->  ok
+    ##      resize <name> <rows> <cols>        ->  ok
+
+    def __init__( self, _path, _scrollback ):
+
+        self.path       = _path
+        self.scrollback = _scrollback
+
+        self.sessions   = {}        ##  name -> session dict
+        self.fds        = {}        ##  pty fd -> name
+        self.clients    = {}        ##  socket -> client dict
+
+################################################################################
+
+    def serve( self ):
+
+        self.listener = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        self.listener.bind( self.path )
+        self.listener.listen( 8 )
+
+        os.chmod( self.path, 0600 )
+
+        while 1:
+
+            rlist = [ self.listener ] + self.fds.keys() + self.clients.keys()
+            wlist = [ c for c in self.clients.keys() if self.clients[ c ][ 'out' ] ]
+
+            try:
+                r, w, e = select.select( rlist, wlist, [] )
+
+            except select.error, e:
+
+                if e[ 0 ] == errno.EINTR:
+                    continue
+
+                raise
+
+            for sock in w:
+                if sock in self.clients:
+                    self.flush_client( sock )
+
+            for obj in r:
+
+                if obj is self.listener:
+
+                    conn, addr = self.listener.accept()
+                    conn.setblocking( 0 )
+
+                    self.clients[ conn ] = { 'name' : None, 'req' : '', 'out' : '', 'close' : 0 }
+
+                elif obj in self.fds:
+                    self.session_read( obj )
+
+                elif obj in self.clients:
+                    self.client_read( obj )
+
+            ##  Nothing left to look after, go away until the next attach
+
+            if not self.sessions and not self.clients:
+                break
+
+        self.listener.close()
+        os.unlink( self.path )
+
+################################################################################
+
+    def spawn( self, _name, _sh, _arg ):
+
+        pid, fd = spawn_pty( _sh, _arg )
+
+        self.sessions[ _name ] = { 'pid' : pid, 'fd' : fd, 'data' : '', 'end' : 0, 'clients' : [] }
+        self.fds[ fd ] = _name
+
+        return self.sessions[ _name ]
+
+################################################################################
+
+    def session_read( self, _fd ):
+
+        name = self.fds[ _fd ]
+        sess = self.sessions[ name ]
+
+        try:
+            data = os.read( _fd, 65536 )
+
+        except OSError:
+            data = ''               ##  EIO, shell is gone
+
+        if data == '':
+            self.end_session( name )
+            return
+
+        sess[ 'end' ]  += len( data )
+        sess[ 'data' ] += data
+
+        ##  Trim in big steps so we're not copying the scrollback every read
+
+        if len( sess[ 'data' ] ) > 2 * self.scrollback:
+            sess[ 'data' ] = sess[ 'data' ][ -self.scrollback: ]
+
+        for sock in sess[ 'clients' ][:]:
+            self.queue( sock, data )
+
+################################################################################
+
+    def end_session( self, _name ):
+
+        sess = self.sessions[ _name ]
+
+        try:
+            os.close( sess[ 'fd' ] )
+            os.waitpid( sess[ 'pid' ], os.WNOHANG )
+
+        except OSError:
+            pass
+
+        ##  Closing the attached connections is how vim finds out
+
+        for sock in sess[ 'clients' ][:]:
+            self.clients[ sock ][ 'close' ] = 1
+            self.flush_client( sock )
+
+        del self.fds[ sess[ 'fd' ] ]
+        del self.sessions[ _name ]
+
+################################################################################
+
+    def client_read( self, _sock ):
+
+        client = self.clients[ _sock ]
+
+        try:
+            data = _sock.recv( 65536 )
+
+        except socket.error:
+            data = ''
+
+        if data == '':
+            self.drop_client( _sock )
+            return
+
+        if client[ 'name' ] != None:
+
+            ##  Attached, everything is input for the shell
+
+            if client[ 'name' ] in self.sessions:
+                os.write( self.sessions[ client[ 'name' ] ][ 'fd' ], data )
+
+            return
+
+        client[ 'req' ] += data
+
+        if '\n' in client[ 'req' ]:
+
+            line, rest = string.split( client[ 'req' ], '\n', 1 )
+            client[ 'req' ] = ''
+
+            self.handle_request( _sock, string.split( line, '\t' ), rest )
+
+################################################################################
+
+    def handle_request( self, _sock, _req, _rest ):
+
+        client = self.clients[ _sock ]
+
+        if _req[ 0 ] == 'attach' and len( _req ) == 5:
+
+            name, sh, arg, offset = _req[ 1: ]
+
+            if name in self.sessions:
+                sess = self.sessions[ name ]
+
+            else:
+                sess = self.spawn( name, sh, arg )
+
+            ##  Only hand back what the client hasn't seen, or everything
+            ##  kept if it's asking for more than we have ( new vim )
+
+            start  = sess[ 'end' ] - len( sess[ 'data' ] )
+            offset = int( offset )
+
+            if offset < start or offset > sess[ 'end' ]:
+                offset = start
+
+            tail = sess[ 'data' ][ offset - start: ]
+
+            client[ 'name' ] = name
+            sess[ 'clients' ].append( _sock )
+
+            self.queue( _sock, 'ok\t%d\t%d\t%d\n' % ( sess[ 'pid' ], offset, len( tail ) ) + tail )
+
+            if _rest:
+                os.write( sess[ 'fd' ], _rest )
+
+        elif _req[ 0 ] == 'list':
+
+            reply = ''
+
+            for name, sess in self.sessions.items():
+                reply += '%s\t%d\t%d\n' % ( name, sess[ 'pid' ], sess[ 'end' ] )
+
+            client[ 'close' ] = 1
+            self.queue( _sock, reply )
+
+        elif _req[ 0 ] == 'kill' and len( _req ) == 2:
+
+            if _req[ 1 ] in self.sessions:
+
+                try:
+                    os.kill( self.sessions[ _req[ 1 ] ][ 'pid' ], signal.SIGKILL )
+
+                except OSError:
+                    pass
+
+            client[ 'close' ] = 1
+            self.queue( _sock, 'ok\n' )
+
+        elif _req[ 0 ] == 'resize' and len( _req ) == 4:
+
+            if _req[ 1 ] in self.sessions:
+                set_pty_winsize( self.sessions[ _req[ 1 ] ][ 'fd' ], int( _req[ 2 ] ), int( _req[ 3 ] ) )
+
+            client[ 'close' ] = 1
+            self.queue( _sock, 'ok\n' )
+
+        else:
+
+            client[ 'close' ] = 1
+            self.queue( _sock, 'error\n' )
+
+################################################################################
+
+    def queue( self, _sock, _data ):
+
+        client = self.clients[ _sock ]
+        client[ 'out' ] += _data
+
+        ##  A vim that isn't reading can't hold us up.  Rather than drop
+        ##  bytes out of its stream let it go, it attaches again from the
+        ##  offset it got to ( vimsh_engine.reattach ).  An attach reply is
+        ##  never more than the scrollback kept ( 2 * scrollback ).
+
+        if len( client[ 'out' ] ) > 4 * self.scrollback:
+            self.drop_client( _sock )
+            return
+
+        self.flush_client( _sock )
+
+################################################################################
+
+    def flush_client( self, _sock ):
+
+        client = self.clients[ _sock ]
+
+        if client[ 'out' ]:
+
+            try:
+                sent = _sock.send( client[ 'out' ] )
+                client[ 'out' ] = client[ 'out' ][ sent: ]
+
+            except socket.error, e:
+
+                if e[ 0 ] not in ( errno.EAGAIN, errno.EWOULDBLOCK ):
+                    self.drop_client( _sock )
+
+                return
+
+        if client[ 'close' ] and not client[ 'out' ]:
+            self.drop_client( _sock )
+
+################################################################################
+
+    def drop_client( self, _sock ):
+
+        client = self.clients[ _sock ]
+
+        if client[ 'name' ] in self.sessions:
+            self.sessions[ client[ 'name' ] ][ 'clients' ].remove( _sock )
+
+        del self.clients[ _sock ]
+
+        ##  close() alone leaves the connection up while anything still
+        ##  refers to the socket, vim has to see the end of it now
+
+        try:
+            _sock.shutdown( socket.SHUT_RDWR )
+
+        except socket.error:
+            pass
+
+        _sock.close()
+
+################################################################################
+##                          class vimsh_history                               ##
+################################################################################
+
+class vimsh_history:
+
+    ##  Command history shared by every vimsh session ( and every vim ).  The
+    ##  file is append only, one command per line with newlines escaped, so
+    ##  sessions never rewrite it and only have to read what others appended
+    ##  since they last looked.
+    ##
+    ##  Kept in memory:
+    ##
+    ##      entries     every command, oldest first
+    ##      sorted      unique commands, sorted, for prefix lookups
+    ##      last        command -> index of its most recent use
+    ##      text        entries joined by '\n' and starts[], the offset of
+    ##                  each entry in it, so substring search is a C level
+    ##                  rfind plus a bisect rather than a loop over entries
+
+    def __init__( self, _path ):
+
+        self.path    = _path
+        self.loaded  = 0            ##  bytes of the file indexed so far
+
+        self.entries = []
+        self.sorted  = []
+        self.last    = {}
+        self.starts  = []
+
+        self.text    = ''
+        self.pending = []           ##  not yet joined onto text
+
+################################################################################
+
+    def add( self, _cmd ):
+
+        ##  One write with O_APPEND so concurrent vims don't interleave.
+        ##  The entry is indexed on the next sync like everyone else's.
+
+        line = string.replace( string.replace( _cmd, '\\', '\\\\' ), '\n', '\\n' )
+
+        fd = os.open( self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600 )
+
+        try:
+            os.write( fd, line + '\n' )
+
+        finally:
+            os.close( fd )
+
+################################################################################
+
+    def sync( self ):
+
+        ##  Index whatever was appended since last time
+
+        try:
+            size = os.stat( self.path ).st_size
+
+        except OSError:
+            return
+
+        if size <= self.loaded:
+            return
+
+        f = open( self.path, 'rb' )
+        f.seek( self.loaded )
+        data = f.read( size - self.loaded )
+        f.close()
+
+        ##  Only whole lines, a writer may be half way through one
+
+        end = string.rfind( data, '\n' )
+
+        if end < 0:
+            return
+
+        self.loaded += end + 1
+
+        new  = string.split( data[ :end ], '\n' )
+        bulk = len( new ) > 1000
+
+        pos = len( self.text ) + sum( [ len( p ) for p in self.pending ] )
+
+        for line in new:
+
+            cmd = line
+
+            if '\\' in line:
+                cmd = line.decode( 'string_escape' )    ##  undo add()'s escaping
+
+            if cmd not in self.last and not bulk:
+                bisect.insort( self.sorted, cmd )
+
+            self.last[ cmd ] = len( self.entries )
+            self.entries.append( cmd )
+
+            self.starts.append( pos )
+            self.pending.append( line + '\n' )
+
+            pos += len( line ) + 1
+
+        if bulk:
+            self.sorted = self.last.keys()
+            self.sorted.sort()
+
+################################################################################
+
+    def prefix_before( self, _prefix, _before, _seen ):
+
+        ##  Most recently used command starting with _prefix that was used
+        ##  before entry _before and isn't in _seen.  Returns ( idx, cmd ).
+
+        self.sync()
+
+        lo = bisect.bisect_left( self.sorted, _prefix )
+        hi = bisect.bisect_left( self.sorted, _prefix + '\xff', lo )
+
+        if lo == hi:
+            return None
+
+        if hi - lo <= 256:
+
+            ##  Few enough candidates, pick by recency directly
+
+            best = None
+
+            for cmd in self.sorted[ lo:hi ]:
+
+                idx = self.last[ cmd ]
+
+                if idx < _before and cmd not in _seen and ( best == None or idx > best[ 0 ] ):
+                    best = ( idx, cmd )
+
+            return best
+
+        ##  Lots of candidates ( short prefix ), so matches are dense and
+        ##  walking back from _before finds one quickly
+
+        for idx in xrange( min( _before, len( self.entries ) ) - 1, -1, -1 ):
+
+            cmd = self.entries[ idx ]
+
+            if cmd[ :len( _prefix ) ] == _prefix and cmd not in _seen:
+                return ( idx, cmd )
+
+        return None
+
+################################################################################
+
+    def search( self, _sub, _max ):
+
+        ##  Up to _max unique commands containing _sub, newest first
+
+        self.sync()
+
+        if self.pending:
+            self.text    = self.text + string.join( self.pending, '' )
+            self.pending = []
+
+        sub   = string.replace( string.replace( _sub, '\\', '\\\\' ), '\n', '\\n' )
+        end   = len( self.text )
+        found = []
+
+        while len( found ) < _max:
+
+            pos = string.rfind( self.text, sub, 0, end )
+
+            if pos < 0:
+                break
+
+            idx = bisect.bisect_right( self.starts, pos ) - 1
+            cmd = self.entries[ idx ]
+
+            ##  A hit in the escaped text isn't always one in the command,
+            ##  'n' is found in the \n add() writes for a newline
+
+            if _sub in cmd and cmd not in found:
+                found.append( cmd )
+
+            end = self.starts[ idx ]
+
+        return found
+
+################################################################################
+##                          class vimsh_exe_index                             ##
+################################################################################
+
+class vimsh_exe_index:
+
+    ##  Sorted names of everything executable on $PATH for completing
+    ##  command names.  Each directory's listing is kept with its mtime and
+    ##  only rescanned when that changes, so a completion is a stat per
+    ##  $PATH entry and a bisect.
+
+    def __init__( self ):
+
+        self.path   = None
+        self.dirs   = {}        ##  dir -> ( mtime, names )
+        self.sorted = []
+
+################################################################################
+
+    def refresh( self ):
+
+        path    = os.environ.get( 'PATH', '' )
+        changed = ( path != self.path )
+
+        self.path = path
+
+        for d in string.split( path, os.pathsep ):
+
+            try:
+                mtime = os.stat( d ).st_mtime
+
+            except OSError:
+                mtime = None
+
+            if d in self.dirs and self.dirs[ d ][ 0 ] == mtime:
+                continue
+
+            dbg_print( 'vimsh_exe_index: scanning ' + d )
+
+            names = []
+
+            if mtime != None:
+
+                try:
+
+                    for name in os.listdir( d ):
+                        if os.access( os.path.join( d, name ), os.X_OK ):
+                            names.append( name )
+
+                except OSError:
+                    pass
+
+            self.dirs[ d ] = ( mtime, names )
+            changed = 1
+
+        if changed:
+
+            ##  Only directories still on $PATH count
+
+            all_names = {}
+
+            for d in string.split( path, os.pathsep ):
+                for name in self.dirs[ d ][ 1 ]:
+                    all_names[ name ] = 1
+
+            self.sorted = all_names.keys()
+            self.sorted.sort()
+
+################################################################################
+
+    def complete( self, _prefix ):
+
+        self.refresh()
+
+        lo = bisect.bisect_left( self.sorted, _prefix )
+        hi = bisect.bisect_left( self.sorted, _prefix + '\xff', lo )
+
+        return self.sorted[ lo:hi ]
+
+################################################################################
+##                          class vimsh_dir_cache                             ##
+################################################################################
+
+class vimsh_dir_cache:
+
+    ##  Sorted directory listings for filename completion, revalidated by
+    ##  the directory's mtime so big trees ( node_modules ) are only read
+    ##  once until they change.
+
+    max_dirs = 512
+
+    def __init__( self ):
+
+        self.dirs = {}          ##  path -> ( mtime, names, subdirs or None )
+
+################################################################################
+
+    def listing( self, _dir ):
+
+        ##  Returns ( sorted names, dict of the ones that are directories ).
+        ##  Without scandir the dict is None and it's up to the caller to
+        ##  stat the few names it actually uses.
+
+        try:
+            mtime = os.stat( _dir ).st_mtime
+
+        except OSError:
+            return [], {}
+
+        cached = self.dirs.get( _dir )
+
+        if cached and cached[ 0 ] == mtime:
+            return cached[ 1 ], cached[ 2 ]
+
+        dbg_print( 'vimsh_dir_cache: scanning ' + _dir )
+
+        names   = []
+        subdirs = None
+
+        try:
+
+            if scandir:
+
+                subdirs = {}
+
+                for entry in scandir( _dir ):
+
+                    names.append( entry.name )
+
+                    try:
+                        if entry.is_dir():
+                            subdirs[ entry.name ] = 1
+
+                    except OSError:
+                        pass
+
+            else:
+                names = os.listdir( _dir )
+
+        except OSError:
+            return [], {}
+
+        names.sort()
+
+        if len( self.dirs ) >= self.max_dirs:
+            self.dirs = {}
+
+        self.dirs[ _dir ] = ( mtime, names, subdirs )
+
+        return names, subdirs
+
+################################################################################
+
+    def complete( self, _word, _cwd, _max = 500 ):
+
+        ##  Filenames starting with _word, relative to _cwd, as typed
+        ##  ( i.e. '~/sr' -> '~/src/' ), directories get a trailing '/'
+
+        dir_part, base = os.path.split( _word )
+
+        lookup = os.path.join( _cwd, os.path.expanduser( dir_part ) )
+
+        names, subdirs = self.listing( lookup )
+
+        lo = bisect.bisect_left( names, base )
+        hi = bisect.bisect_left( names, base + '\xff', lo )
+
+        candidates = []
+
+        for name in names[ lo:min( hi, lo + _max ) ]:
+
+            if name[ :1 ] == '.' and base[ :1 ] != '.':
+                continue
+
+            if subdirs != None:
+                is_dir = name in subdirs
+
+            else:
+                is_dir = os.path.isdir( os.path.join( lookup, name ) )
+
+            if is_dir:
+                name = name + '/'
+
+            candidates.append( os.path.join( dir_part, name ) )
+
+        return candidates
+
+################################################################################
+##                            class vimsh_archive                             ##
+################################################################################
+
+class vimsh_archive:
+
+    ##  Outputs thrown away from vimsh buffers ( clear_screen ), zlib
+    ##  compressed and keyed by ( command, time it ran ).  Kept up to
+    ##  budget compressed bytes, the least recently added/restored go
+    ##  first when it's over.
+
+    def __init__( self, _budget ):
+
+        self.budget  = _budget
+        self.size    = 0
+        self.entries = {}       ##  ( cmd, time ) -> ( buffer name, line count, compressed lines )
+        self.order   = []       ##  keys, least recently used first
+
+################################################################################
+
+    def add( self, _name, _cmd, _time, _lines ):
+
+        data = zlib.compress( string.join( _lines, '\n' ) )
+
+        if len( data ) > self.budget:
+            return
+
+        key = ( _cmd, _time )
+
+        if key in self.entries:
+            self.drop( key )
+
+        self.entries[ key ] = ( _name, len( _lines ), data )
+        self.order.append( key )
+        self.size += len( data )
+
+        while self.size > self.budget:
+            self.drop( self.order[ 0 ] )
+
+################################################################################
+
+    def drop( self, _key ):
+
+        self.size -= len( self.entries[ _key ][ 2 ] )
+
+        del self.entries[ _key ]
+        self.order.remove( _key )
+
+################################################################################
+
+    def get( self, _key ):
+
+        self.order.remove( _key )
+        self.order.append( _key )
+
+        return string.split( zlib.decompress( self.entries[ _key ][ 2 ] ), '\n' )
+
+################################################################################
+
+    def keys( self ):
+
+        ##  Newest first, the numbering :VimShArchive uses
+
+        keys = self.entries.keys()
+        keys.sort( key = lambda k: k[ 1 ], reverse = True )
+
+        return keys
+
+################################################################################
+##                          class vimsh_search_index                          ##
+################################################################################
+
+class vimsh_search_index:
+
+    ##  Trigram index over the output of every vimsh session, fed a line at
+    ##  a time from the rendering path ( vimsh.line_done ).  Each indexed
+    ##  line gets an id, the postings for a trigram are an array of ids, and
+    ##  two more arrays map an id back to ( session, absolute line ).
+    ##  A search intersects the postings of the trigrams the pattern can't
+    ##  match without, then checks just those lines with the real regex.
+    ##
+    ##  Trigrams are lower cased so the index also works for ( ?i ) patterns.
+    ##  Only the first max_len characters of a line are indexed, longer lines
+    ##  are always checked.
+
+    max_len = 1024
+
+    def __init__( self ):
+
+        self.postings = {}                  ##  trigram -> array of ids
+        self.sids     = array.array( 'i' )  ##  id -> session id
+        self.lines    = array.array( 'l' )  ##  id -> absolute line
+        self.long     = array.array( 'l' )  ##  ids of lines over max_len
+        self.dead     = 0                   ##  roughly how many ids are stale
+
+################################################################################
+
+    def add( self, _sid, _line, _text ):
+
+        lid  = len( self.sids )
+        text = string.lower( _text[ :self.max_len ] )
+
+        self.sids.append( _sid )
+        self.lines.append( _line )
+
+        if len( _text ) > self.max_len:
+            self.long.append( lid )
+
+        postings = self.postings
+
+        for tri in set( [ text[ i:i + 3 ] for i in xrange( len( text ) - 2 ) ] ):
+
+            if tri in postings:
+                postings[ tri ].append( lid )
+
+            else:
+                postings[ tri ] = array.array( 'l', [ lid ] )
+
+################################################################################
+
+    def candidates( self, _literals ):
+
+        ##  Ids of lines that contain all of _literals, None if the
+        ##  literals are too short to narrow anything down
+
+        trigrams = {}
+
+        for lit in _literals:
+
+            lit = string.lower( lit )
+
+            for i in range( len( lit ) - 2 ):
+                trigrams[ lit[ i:i + 3 ] ] = 1
+
+        if not trigrams:
+            return None
+
+        lists = []
+
+        for tri in trigrams.keys():
+
+            if tri not in self.postings:
+                return list( self.long )
+
+            lists.append( self.postings[ tri ] )
+
+        lists.sort( key = len )
+
+        ids = set( lists[ 0 ] )
+
+        for l in lists[ 1: ]:
+
+            ids.intersection_update( l )
+
+            if not ids:
+                break
+
+        ids.update( self.long )
+
+        return sorted( ids )
+
+################################################################################
+
+    def compact( self, _live ):
+
+        ##  Drop ids for lines that were evicted or whose session is gone.
+        ##  _live is session id -> lines evicted from the top of its buffer.
+
+        keep = {}
+
+        sids   = array.array( 'i' )
+        lines  = array.array( 'l' )
+
+        for lid in xrange( len( self.sids ) ):
+
+            sid = self.sids[ lid ]
+
+            if sid in _live and self.lines[ lid ] > _live[ sid ]:
+
+                keep[ lid ] = len( sids )
+
+                sids.append( sid )
+                lines.append( self.lines[ lid ] )
+
+        for tri, ids in self.postings.items():
+
+            ids = array.array( 'l', [ keep[ lid ] for lid in ids if lid in keep ] )
+
+            if ids:
+                self.postings[ tri ] = ids
+
+            else:
+                del self.postings[ tri ]
+
+        self.long  = array.array( 'l', [ keep[ lid ] for lid in self.long if lid in keep ] )
+        self.sids  = sids
+        self.lines = lines
+        self.dead  = 0
+
+################################################################################
+##                           Helper functions                                 ##
+################################################################################
+        
+def test_and_set( _vim_var, _default_val ):
+
+    ret = _default_val
+
+    if vim == None:
+        return ret              ##  headless, defaults only
+
+    vim.command( 'let dummy = exists( "' + _vim_var + '" )' )
+    exists = vim.eval( 'dummy' )
+
+    ##  exists will always be a string representation of the evaluation
+
+    if exists != '0':
+        ret = vim.eval( _vim_var )
+        dbg_print( 'test_and_set: variable ' + _vim_var + ' exists, using supplied ' + ret )
+
+    else:
+        dbg_print( 'test_and_set: variable ' + _vim_var + ' doesn\'t exist, using default ' + ret )
+
+    return ret
+
+################################################################################
+
+def dump_str_as_hex( _str ):
+
+    hex_str = ''
+
+    print 'length of string is ' + str( len( _str ) )
+
+    for x in range( 0, len( _str ) ):
+        hex_str = hex_str + hex( ord( _str[x] ) ) + '\n'
+
+    print 'raw line ( hex ) is:'
+    print hex_str
+
+################################################################################
+
+def dbg_print( _str ):
+
+    if _DEBUG_:
+        print _str
+
+################################################################################
+
+def new_buf( _filename ):
+
+    ##  If a buffer named vimsh doesn't exist create it, if it
+    ##  does, switch to it.  Use the config options for splitting etc.
+
+    filename = _filename
+
+    try:
+        vim.command( 'let dummy = buflisted( "' + filename + '" )' )
+        exists = vim.eval( 'dummy' )
+
+        if exists == '0':
+            dbg_print( 'new_buf: buffer ' + filename + ' doesn\'t exist' )
+
+            if split_open == '0':
+                vim.command( 'edit ' + filename )
+
+            else:
+                vim.command( 'new ' + filename )
+
+            vim.command( 'setlocal buftype=nofile' )
+            vim.command( 'setlocal bufhidden=hide' )
+            vim.command( 'setlocal noswapfile' )
+            vim.command( 'setlocal tabstop=4' )
+            vim.command( 'setlocal modifiable' )
+            vim.command( 'setlocal nowrap' )
+            vim.command( 'setlocal textwidth=999' )
+            vim.command( 'setfiletype vim_shell' )
+
+            vim.command( 'au BufDelete ' + filename + ' :python lookup_buf( "' + filename + '" ).cleanup()' )
+
+            vim.command( 'inoremap <buffer> <CR>  <ESC>:python lookup_buf( "' + filename + '" ).execute_cmd()<CR>' )
+
+            vim.command( 'inoremap <buffer> ' + timeout_key + ' <ESC>:python lookup_buf( "' + filename + '" ).set_timeout()<CR>' )
+            vim.command( 'nnoremap <buffer> ' + timeout_key + ' :python lookup_buf( "' + filename + '" ).set_timeout()<CR>' )
+
+            vim.command( 'inoremap <buffer> ' + new_prompt_key + ' <ESC>:python lookup_buf ( "' + filename + '" ).new_prompt()<CR>' )
+            vim.command( 'nnoremap <buffer> ' + new_prompt_key + ' :python lookup_buf( "' + filename + '" ).new_prompt()<CR>' )
+
+            vim.command( 'inoremap <buffer> ' + page_output_key + ' <ESC>:python lookup_buf ( "' + filename + '" ).page_output()<CR>' )
+            vim.command( 'nnoremap <buffer> ' + page_output_key + ' :python lookup_buf( "' + filename + '" ).page_output()<CR>' )
+
+            vim.command( 'inoremap <buffer> ' + intr_signal_key + ' <ESC>:python lookup_buf ( "' + filename + '" ).send_intr()<CR>' )
+            vim.command( 'nnoremap <buffer> ' + intr_signal_key + ' :python lookup_buf( "' + filename + '" ).send_intr()<CR>' )
+
+            vim.command( 'inoremap <buffer> ' + clear_key + ' <ESC>:python lookup_buf ( "' + filename + '" ).clear_screen( True )<CR>')
+
+            vim.command( 'inoremap <buffer> ' + complete_key + ' <C-r>=VimShComplete()<CR>' )
+
+
+            ##  No history, leave the keys ( <Up>/<Down> ) alone
+
+            if history_file != '':
+                vim.command( 'inoremap <buffer> ' + history_prev_key + ' <ESC>:python lookup_buf( "' + filename + '" ).history_recall( 1 )<CR>' )
+                vim.command( 'inoremap <buffer> ' + history_next_key + ' <ESC>:python lookup_buf( "' + filename + '" ).history_recall( 0 )<CR>' )
+
+            vim.command( 'nnoremap <buffer> ' + clear_key + ' :python lookup_buf( "' + filename + '").clear_screen( False )<CR>' )
+
+            if not self.using_pty:
+                vim.command( 'inoremap <buffer> ' + eof_signal_key + ' <ESC>:python lookup_buf ( "' + filename + '" ).send_eof()<CR>' )
+                vim.command( 'nnoremap <buffer> ' + eof_signal_key + ' :python lookup_buf( "' + filename + '" ).send_eof()<CR>' )
+
+            return 0
+
+        else:
+
+            dbg_print( 'new_buf: file ' + filename + ' exists' )
+
+            vim.command( 'edit ' + filename )
+            return 1
+
+    except:
+        dbg_print( 'new_buf: exception!' + str( sys.exc_info()[0] ) )
+
+################################################################################
+
+def spawn_buf( _filename ):
+
+    exists = new_buf( _filename )
+
+    if not exists:
+
+        dbg_print( 'spawn_buf: buffer doesn\'t exist so creating a new one' )
+        
+        cur = vim.current.buffer
+
+        ##  Make vimsh associate buffer with _filename and add to list of buffers
+        vim_shell = vimsh( sh, arg, _filename )
+
+        _BUFFERS_.append( ( _filename, vim_shell ) )
+
+        if use_daemon == '1':
+
+            ##  Shell may already be running in the daemon, show what it
+            ##  has kept and carry on from there
+
+            tail = vim_shell.setup_daemon()
+            vim_shell.sync_winsize()
+
+            if tail:
+                vim_shell.print_bulk( tail )
+                vim_shell.read( 0.02 )
+
+            else:
+                vim_shell.read()
+
+        else:
+
+            warm = None
+
+            if use_pty:
+                warm = take_from_pool()
+
+            vim_shell.setup_pty( use_pty, warm )
+            vim_shell.sync_winsize()
+
+            ##  If the warm shell's prompt is already waiting don't sit
+            ##  through the full read timeout for it.
+
+            if warm and select.select( [ vim_shell.outd ], [], [], 0 )[0]:
+                vim_shell.read( 0.02 )
+
+            else:
+                vim_shell.read()
+
+            if use_pty:
+                fill_pool()
+        cur_line, cur_row = vim_shell.get_vim_cursor_pos()
+
+        ##  last line *should* be prompt, tuck it away for syntax hilighting
+        hi_prompt = cur[ cur_line - 1 ]
+
+    else:
+
+        dbg_print( 'main: buffer does exist' )
+        vim.command( 'normal G$' )
+        vim_shell = lookup_buf( _filename )
+
+        if vim_shell and vim_shell.detached:
+
+            ##  Only what came out while we were away
+
+            vim_shell.print_bulk( vim_shell.setup_daemon() )
+            vim_shell.sync_winsize()
+            vim_shell.read( 0.02 )
+
+    vim.command( 'startinsert!' ) 
+
+################################################################################
+
+def spawn_pty( _sh, _arg ):
+
+    ##  Fork a shell on a new pty, returns ( pid, fd ) in vim's process
+
+    pid, fd = pty.fork()
+
+    if pid == 0:
+
+        ##  In spawned shell process, NOTE: any 'print'ing done within
+        ##  here will corrupt vim.
+
+        attrs = tty.tcgetattr( 1 )
+
+        attrs[ 6 ][ tty.VMIN ]  = 1
+        attrs[ 6 ][ tty.VTIME ] = 0
+        attrs[ 0 ] = attrs[ 0 ] | tty.BRKINT
+        attrs[ 0 ] = attrs[ 0 ] & tty.IGNBRK
+        attrs[ 3 ] = attrs[ 3 ] & ~tty.ICANON & ~tty.ECHO
+
+        tty.tcsetattr( 1, tty.TCSANOW, attrs )
+
+        try:
+
+            if _arg != '':
+                os.execv( _sh, [ _sh, _arg ] )
+
+            else:
+                os.execv( _sh, [ _sh, ] )
+
+        except:
+
+            print( 'spawn_pty: Couldn\'t start specified shell ' + _sh )
+            os._exit( 1 )
+
+    return pid, fd
+
+################################################################################
+
+def set_pty_winsize( _fd, _rows, _cols ):
+
+    fcntl.ioctl( _fd, termios.TIOCSWINSZ, struct.pack( 'HHHH', _rows, _cols, 0, 0 ) )
+
+################################################################################
+
+def sync_winsizes():
+
+    ##  Autocommand when windows change size, only the ones that did get
+    ##  told
+
+    for key, val in _BUFFERS_:
+
+        if not val.detached:
+            val.sync_winsize()
+
+################################################################################
+
+def fill_pool():
+
+    ##  Keep pool_size shells forked and starting up in the background so
+    ##  VimShNewBuf doesn't have to wait on rc files and the first prompt.
+    ##  Forking is cheap, the shells do their startup on their own time.
+
+    key = pool_key()
+
+    while len( _POOL_ ) < pool_size:
+
+        pid, fd = spawn_pty( sh, arg )
+        dbg_print( 'fill_pool: warm shell pid ' + str( pid ) )
+
+        _POOL_.append( ( key, pid, fd ) )
+
+################################################################################
+
+def pool_key():
+
+    ##  Everything a shell forked now would pick up from vim, a warm shell
+    ##  forked with something else ( i.e. before :cd ) isn't used
+
+    return ( sh, arg, os.getcwd(), sorted( os.environ.items() ) )
+
+################################################################################
+
+def take_from_pool():
+
+    ##  Returns ( pid, fd ) of a live warm shell that matches the current
+    ##  shell settings, directory and environment, or None.  Stale or dead
+    ##  ones are thrown away.
+
+    key = pool_key()
+
+    while _POOL_:
+
+        warm_key, pid, fd = _POOL_.pop( 0 )
+
+        try:
+            alive = ( os.waitpid( pid, os.WNOHANG )[0] == 0 )
+
+        except OSError:
+            alive = 0
+
+        if alive and warm_key == key:
+
+            dbg_print( 'take_from_pool: adopting warm shell pid ' + str( pid ) )
+            return pid, fd
+
+        dbg_print( 'take_from_pool: discarding warm shell pid ' + str( pid ) )
+        kill_pty( pid, fd )
+
+    return None
+
+################################################################################
+
+def drain_pool():
+
+    ##  NOTE: Only called via autocommand when vim exits
+
+    while _POOL_:
+
+        key, pid, fd = _POOL_.pop()
+        kill_pty( pid, fd )
+
+################################################################################
+
+def kill_pty( _pid, _fd ):
+
+    try:
+        os.kill( _pid, signal.SIGKILL )
+        os.waitpid( _pid, 0 )
+
+    except OSError:
+        dbg_print( 'kill_pty: process probably already gone' )
+
+    try:
+        os.close( _fd )
+
+    except OSError:
+        pass
+
+################################################################################
+
+def start_daemon():
+
+    ##  Fork off a vimsh_daemon, detached from vim so it survives it.  The
+    ##  daemon is just this module running in a double forked child.
 
-        vim.command( 'au! BufDelete ' + self.filename )
+    check_sock_dir()
 
-        remove_buf( self.filename )
+    pid = os.fork()
+
+    if pid == 0:
 
         try:
+            os.setsid()
 
-            if self.using_pty:
-                os.kill( self.pid, signal.SIGKILL )
+            if os.fork() == 0:
 
-        except:
-            dbg_print( 'cleanup: Exception, process probably already killed' )
+                ##  Don't hang on to vim's tty or any of its ptys, those
+                ##  shells should still see a hangup when vim goes away
+
+                devnull = os.open( os.devnull, os.O_RDWR )
+
+                for fd in ( 0, 1, 2 ):
+                    os.dup2( devnull, fd )
+
+                os.closerange( 3, 1024 )
+
+                signal.signal( signal.SIGCHLD, signal.SIG_DFL )
+                signal.signal( signal.SIGINT,  signal.SIG_IGN )
+                signal.signal( signal.SIGHUP,  signal.SIG_IGN )
+
+                if os.path.exists( daemon_socket ):
+                    os.unlink( daemon_socket )      ##  stale, nobody answered
+
+                vimsh_daemon( daemon_socket, daemon_scrollback ).serve()
+
+        finally:
+            os._exit( 0 )
+
+    os.waitpid( pid, 0 )
 
 ################################################################################
 
-    def send_intr( self ):
+def check_sock_dir():
 
-        dbg_print( 'send_intr: enter' )
+    ##  Whoever owns the socket's directory decides who answers on it, and
+    ##  that gets every command and password typed.  It has to be ours and
+    ##  closed to everybody else.
 
-        if show_workaround_msgs == '1':
-            print 'If you do NOT see a prompt in the vimsh buffer, press F5 or go into insert mode and press Enter'
-            print 'If you need a new prompt press F4'
-            print 'NOTE: To disable this help message set \'g:vimsh_show_workaround_msgs\' to 0 in your .vimrc'
+    sock_dir = os.path.dirname( daemon_socket )
 
-        ##  This triggers another KeyboardInterrupt async
+    if not os.path.lexists( sock_dir ):
+        os.makedirs( sock_dir, 0700 )
+
+    st = os.lstat( sock_dir )
+
+    if not stat.S_ISDIR( st.st_mode ) or st.st_uid != os.getuid() or st.st_mode & 077:
+        raise IOError( 'vimsh: not using daemon socket, ' + sock_dir + ' has to be a directory of yours with mode 0700' )
+
+################################################################################
+
+def daemon_connect():
+
+    ##  Connect to the daemon, starting one if nobody is listening
+
+    started = 0
+
+    check_sock_dir()
+
+    for attempt in range( 50 ):
+
+        sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
 
         try:
+            sock.connect( daemon_socket )
+            return sock
 
-            dbg_print( 'send_intr: writing intr_key' )
+        except socket.error, e:
 
-            if self.using_pty:
-                os.kill( self.pid, signal.SIGINT )
+            sock.close()
 
-            ##  TODO: For this to work, I need to use CreateProcess or subprocess module
-            #else:
-            #    handle = OpenProcess( win32con.PROCESS_ALL_ACCESS, 0, self.pid )
-            #    GenerateConsoleCtrlEvent( win32con.CTRL_C_EVENT, handle )
+            if e[ 0 ] not in ( errno.ENOENT, errno.ECONNREFUSED ):
+                raise
 
-            #self.write( self.intr_key )
+        if not started:
 
-            self.page_output( 1 )
+            dbg_print( 'daemon_connect: no daemon, starting one' )
 
-        except KeyboardInterrupt:
+            start_daemon()
+            started = 1
 
-            dbg_print( 'send_intr: caught KeyboardInterrupt in send_intr' )
-            pass
+        time.sleep( 0.02 )
+
+    raise IOError( 'daemon_connect: couldn\'t connect to ' + daemon_socket )
 
 ################################################################################
 
-    def send_eof( self ):
+def daemon_request( _req ):
 
-        dbg_print( 'send_eof: enter' )
+    ##  One shot request ( list, kill ), returns the reply lines
 
-        try:     ##  could cause shell to exit
+    sock = daemon_connect()
+    sock.sendall( string.join( _req, '\t' ) + '\n' )
 
-            self.write( self.eof_key )
-            self.page_output( 1 )
+    reply = ''
 
-        except Exception, e:        
+    while 1:
 
-            dbg_print( 'send_eof: exception' )
+        data = sock.recv( 65536 )
 
-            self.handle_shell_exited()
+        if data == '':
+            break
+
+        reply += data
+
+    sock.close()
+
+    return string.split( reply, '\n' )[ :-1 ]
 
 ################################################################################
 
-    def handle_exit_cmd( self, _cmd ):
+def sock_read_line( _sock ):
 
-        ##  Exit was typed, could be the spawned shell, or a subprocess like
-        ##  telnet/ssh/etc.
+    line = ''
 
-        dbg_print( 'handle_exit_cmd: enter' )
+    while line[ -1: ] != '\n':
 
-        dbg_print ( 'handle_exit_cmd: writing exit command' )
-        self.write( _cmd[0] + '\n' )
+        c = _sock.recv( 1 )
 
-        self.end_exe_line()
+        if c == '':
+            break
+
+        line += c
+
+    return line[ :-1 ]
+
+################################################################################
+
+def sock_read_exact( _sock, _len ):
+
+    data = ''
+
+    while len( data ) < _len:
+
+        tmp = _sock.recv( _len - len( data ) )
+
+        if tmp == '':
+            break
+
+        data += tmp
+
+    return data
+
+################################################################################
+
+def list_sessions():
+
+    if use_daemon != '1':
+        print 'vimsh: g:vimsh_daemon is not enabled'
+        return
+
+    for line in daemon_request( [ 'list' ] ):
+
+        name, pid, offset = string.split( line, '\t' )
+
+        attached = ''
+
+        if lookup_buf( name ) and not lookup_buf( name ).detached:
+            attached = ' (attached)'
+
+        print '%-20s pid %-8s %s bytes%s' % ( name, pid, offset, attached )
+
+################################################################################
+
+def kill_session( _filename ):
+
+    if use_daemon != '1':
+        print 'vimsh: g:vimsh_daemon is not enabled'
+        return
+
+    daemon_request( [ 'kill', _filename ] )
+
+################################################################################
+
+def current_buf():
+
+    ##  vimsh instance for the buffer we're in, if any
+
+    for key, val in _BUFFERS_:
+
+        if val.buffer.number == vim.current.buffer.number:
+            return val
+
+    return None
+
+################################################################################
+
+def detach_buf():
+
+    vim_shell = current_buf()
+
+    if vim_shell == None or not vim_shell.daemon:
+        print 'vimsh: not a daemon backed vimsh buffer'
+        return
+
+    vim_shell.detach()
+
+    print 'vimsh: detached, :VimShNewBuf ' + vim_shell.filename[ 1:-1 ] + ' to attach again'
+
+################################################################################
+
+def get_history():
+
+    ##  Shared history, loaded the first time it's needed
+
+    global _HISTORY_
+
+    if _HISTORY_ == None and history_file != '':
+        _HISTORY_ = vimsh_history( os.path.expanduser( history_file ) )
+
+    return _HISTORY_
+
+################################################################################
+
+def add_history( _cmd ):
+
+    _cmd = string.strip( _cmd )
+    hist = get_history()
+
+    if hist == None or _cmd == '':
+        return
+
+    try:
+        hist.add( _cmd )
+
+    except ( IOError, OSError ), e:
+        dbg_print( 'add_history: ' + str( e ) )
+
+################################################################################
+
+def search_history( _pattern ):
+
+    ##  Pick a command containing _pattern and put it on the prompt
+
+    vim_shell = current_buf()
+    hist      = get_history()
+
+    if vim_shell == None or hist == None:
+        print 'vimsh: not a vimsh buffer or history disabled'
+        return
+
+    found = hist.search( _pattern, 50 )
+
+    if not found:
+        print 'vimsh: no history matching ' + _pattern
+        vim.command( 'startinsert!' )
+        return
+
+    choices = [ '%2d. %s' % ( i + 1, string.split( found[ i ], '\n' )[ 0 ] ) for i in range( len( found ) ) ]
+
+    vim.command( 'let choice = inputlist( ' + vim_list( [ 'History:' ] + choices ) + ' )' )
+
+    choice = int( vim.eval( 'choice' ) )
+
+    if 0 < choice <= len( found ):
+
+        head = vim_shell.buffer[ vim_shell.prompt_line - 1 ][ :vim_shell.prompt_cursor ]
+        vim_shell.put_cmd( head, found[ choice - 1 ] )
+
+    else:
         vim.command( 'startinsert!' )
 
 ################################################################################
 
-    def handle_shell_exited( self ):
+def complete_at_prompt():
 
-        dbg_print( 'handle_shell_exited: enter' )
+    ##  Called from VimShComplete() ( <Tab> ) in insert mode.  Completes the
+    ##  word before the cursor with vim's complete(), or puts back a plain
+    ##  tab if there's nothing to complete.
 
-        ##  when exiting this way can't have the autocommand
-        ##  for BufDelete run.  It crashes vim.  TODO:  Figure this out.
+    vim.command( 'let g:vimsh_complete_ret = "\t"' )
 
-        vim.command( 'stopinsert' )
-        vim.command( 'au! BufDelete ' + self.filename )
-        vim.command( 'bdelete! ' + self.filename )
+    vim_shell = current_buf()
 
-        remove_buf( self.filename )
+    if vim_shell == None:
+        return
+
+    cur_line, cur_col = vim.current.window.cursor
+    line = vim_shell.buffer[ cur_line - 1 ]
+
+    ##  Only what was typed after the prompt
+
+    start = 0
+
+    if cur_line == vim_shell.prompt_line:
+        start = min( vim_shell.prompt_cursor, cur_col )
+
+    text = line[ start:cur_col ]
+    word = string.split( text + 'x' )[ -1 ][ :-1 ]      ##  'x' keeps a trailing blank
+
+    if word == '':
+        return
+
+    if string.strip( text[ :len( text ) - len( word ) ] ) == '' and '/' not in word:
+        candidates = get_exes().complete( word )
+
+    else:
+        candidates = get_dirs().complete( word, vim_shell.shell_cwd() )
+
+    if not candidates:
+        return
+
+    vim.command( 'call complete( %d, %s )' % ( cur_col - len( word ) + 1, vim_list( candidates ) ) )
+    vim.command( 'let g:vimsh_complete_ret = ""' )
 
 ################################################################################
 
-    def sigchld_handler( self, _sig, _frame ):
+def get_exes():
 
-        dbg_print( 'sigchld_handler: caught SIGCHLD' )
+    global _EXES_
 
-        self.waitpid()
+    if _EXES_ == None:
+        _EXES_ = vimsh_exe_index()
+
+    return _EXES_
 
 ################################################################################
 
-    def sigint_handler( self, _sig, _frame ):
+def get_dirs():
 
-        dbg_print( 'sigint_handler: caught SIGINT' )
-        dbg_print( '' )
+    global _DIRS_
+
+    if _DIRS_ == None:
+        _DIRS_ = vimsh_dir_cache()
+
+    return _DIRS_
+
+################################################################################
+
+def vim_list( _items ):
+
+    ##  python list of strings -> vim list expression
+
+    return '[ ' + string.join( [ vim_str( i ) for i in _items ], ', ' ) + ' ]'
+
+################################################################################
+
+def vim_str( _str ):
+
+    ##  python string -> vim string literal
+
+    return "'" + string.replace( _str, "'", "''" ) + "'"
+
+################################################################################
+
+def required_literals( _pattern ):
+
+    ##  Runs of plain characters every match of the regex _pattern has to
+    ##  contain.  Conservative, anything in a group or next to an
+    ##  alternation doesn't count.
+
+    if '|' in _pattern:
+        return []
+
+    tokens   = re.findall( r'\\.|\[(?:\\.|[^\]])*\]|\{[^}]*\}|[.^$*+?()]|[^\\\[{.^$*+?()]+', _pattern )
+    literals = []
+    depth    = 0
+
+    for i in range( len( tokens ) ):
+
+        tok = tokens[ i ]
+
+        if tok == '(':
+            depth += 1
+
+        elif tok == ')':
+            depth -= 1
+
+        elif depth == 0 and tok[ 0 ] not in '\\[{.^$*+?':
+
+            ##  a quantifier after the run only applies to its last char
+
+            if i + 1 < len( tokens ) and tokens[ i + 1 ][ 0 ] in '*?{':
+                tok = tok[ :-1 ]
+
+            if len( tok ) >= 3:
+                literals.append( tok )
+
+    return literals
+
+################################################################################
+
+def grep_all( _pattern ):
+
+    ##  :VimShGrep, search the output of every vimsh buffer and put the
+    ##  matches in the quickfix list
+
+    try:
+        regex = re.compile( _pattern )
+
+    except re.error, e:
+        print 'vimsh: bad pattern: ' + str( e )
+        return
+
+    sessions = dict( [ ( val.sid, val ) for key, val in _BUFFERS_ ] )
+    matches  = []
+
+    ids = None
+
+    if _INDEX_:
+
+        if _INDEX_.dead > len( _INDEX_.sids ) / 2:
+            _INDEX_.compact( dict( [ ( sid, val.evicted ) for sid, val in sessions.items() ] ) )
+
+        ids = _INDEX_.candidates( required_literals( _pattern ) )
+
+    if ids != None:
+
+        for lid in ids:
+
+            vim_shell = sessions.get( _INDEX_.sids[ lid ] )
+
+            if vim_shell == None:
+                continue
+
+            line = _INDEX_.lines[ lid ] - vim_shell.evicted
+
+            if line < 1 or line > len( vim_shell.buffer ):
+                continue
+
+            text = vim_shell.buffer[ line - 1 ]
+
+            if regex.search( text ):
+                matches.append( ( vim_shell.buffer.number, line, text ) )
+
+    else:
+
+        ##  No index or nothing in the pattern to narrow it down with
+
+        for key, vim_shell in _BUFFERS_:
+
+            buf = vim_shell.buffer
+
+            for line in xrange( len( buf ) ):
+
+                if regex.search( buf[ line ] ):
+                    matches.append( ( buf.number, line + 1, buf[ line ] ) )
+
+    matches.sort()
+
+    qf = [ '{ "bufnr" : %d, "lnum" : %d, "text" : %s }' % ( m[ 0 ], m[ 1 ], vim_str( m[ 2 ] ) ) for m in matches ]
+
+    vim.command( 'call setqflist( [ ' + string.join( qf, ', ' ) + ' ] )' )
+    vim.command( 'cwindow' )
+
+    print 'vimsh: %d matches' % len( matches )
+
+################################################################################
+
+def replay( _args ):
+
+    ##  :VimShReplay file [speed], feed a recording from VimShRecord back
+    ##  through the output path into a new buffer.  speed 1 is real time,
+    ##  2 twice as fast, etc, 0 ( default ) as fast as possible.
+
+    args = string.split( _args )
+
+    if not args:
+        print 'vimsh: usage :VimShReplay file [speed]'
+        return
+
+    speed = 0.0
+
+    try:
+        if len( args ) > 1:
+            speed = float( args[ 1 ] )
+
+        f = open( os.path.expanduser( args[ 0 ] ), 'rb' )
+
+    except ValueError:
+        print 'vimsh: speed should be a number, not ' + args[ 1 ]
+        return
+
+    except IOError, e:
+        print 'vimsh: can\'t read ' + args[ 0 ] + ', ' + str( e )
+        return
+
+    if f.read( len( record_magic ) ) != record_magic:
+        print 'vimsh: ' + args[ 0 ] + ' is not a vimsh recording'
+        f.close()
+        return
+
+    filename = '_replay%d_' % _NEXT_SID_
+
+    new_buf( filename )
+
+    vim_shell = vimsh( sh, arg, filename )
+    _BUFFERS_.append( ( filename, vim_shell ) )
+
+    ##  No process behind it, just something that looks like a pty
+
+    vim_shell.using_pty = 1
+    vim_shell.replay    = 1
+    vim_shell.delay     = 0.2
+    vim_shell.pid       = None
+    vim_shell.eof_key   = ''
+    vim_shell.intr_key  = ''
+
+    header_len = struct.calcsize( '>cdI' )
+    start      = time.time()
+    num_bytes  = 0
+    num_reads  = 0
+
+    while 1:
+
+        header = f.read( header_len )
+
+        if len( header ) < header_len:
+            break
+
+        kind, when, length = struct.unpack( '>cdI', header )
+        data = f.read( length )
+
+        if kind != 'r':
+            continue                ##  input, the echo is in the output
+
+        if speed > 0:
+
+            delay = when / speed - ( time.time() - start )
+
+            if delay > 0:
+                vim.command( 'call VimShRedraw()' )
+                time.sleep( delay )
+
+        vim_shell.render_chunk( data )
+
+        num_bytes += length
+        num_reads += 1
+
+        if not num_reads % 10:
+            vim.command( 'call VimShRedraw()' )
+
+    f.close()
+
+    vim_shell.end_chunks()
+    vim_shell.end_read( num_reads )
 
-        self.waitpid()
+    print 'vimsh: replayed %d bytes in %d reads, %.3f seconds' % ( num_bytes, num_reads, time.time() - start )
 
 ################################################################################
 
-    def waitpid( self ):
+def read_many( _engines, _prompts = None, _timeout = 60 ):
 
-        ##  This routine cannot do anything except for marking that the original
-        ##  shell process has gone away if it has.  This is due to the async
-        ##  nature of signals.
+    ##  Read from a bunch of engines at once, so the whole thing takes as
+    ##  long as the slowest one.  An engine is done when its output ends
+    ##  with its entry in _prompts, or when it has been quiet for its delay
+    ##  ( like read ) in case the prompt changed.  Output goes to each
+    ##  engine's sink as usual.
 
-        if os.waitpid( self.pid, os.WNOHANG )[0]:
+    waiting = {}            ##  fd -> engine
+    last    = {}            ##  fd -> time data last showed up
+    prompt  = {}            ##  fd -> prompt to wait for
 
-            self.shell_exited = 1
-            dbg_print( 'waitpid: shell exited' )
+    now = time.time()
 
-        else:
+    for i in range( len( _engines ) ):
 
-            dbg_print( 'waitpid: shell hasn\'t exited, ignoring' )
+        e = _engines[ i ]
 
-################################################################################
+        waiting[ e.outd ] = e
+        last[ e.outd ]    = now
 
-    def set_timeout( self ):
+        if _prompts and _prompts[ i ]:
+            prompt[ e.outd ] = _prompts[ i ]
 
-        timeout_ok = 0
+    deadline = now + _timeout
 
-        while not timeout_ok:
+    while waiting and now < deadline:
 
-            try:
-                vim.command( 'let timeout = input( "Enter new timeout in seconds (i.e. 0.1), currently set to ' + str( self.delay ) + ' :  " )' )
+        ##  Sleep until the next one would go quiet
 
-            except KeyboardInterrupt:
-                return
+        wait = min( [ deadline ] + [ last[ fd ] + waiting[ fd ].delay for fd in waiting.keys() ] ) - now
 
-            timeout = vim.eval( 'timeout' )
+        if wait > 0:
+            r, w, e = select.select( waiting.keys(), [], [], min( wait, deadline - now ) )
 
-            if timeout == '':               ##  usr cancelled dialog, break out
-                timeout_ok = 1
+        else:
+            r = []
 
-            else:
-                timeout = float( timeout )
-            
-                if timeout >= 0.1:
-                    print '      --->   New timeout is ' + str( timeout ) + ' seconds'
-                    self.delay = timeout
-                    timeout_ok = 1
+        for fd in r:
 
-################################################################################
+            engine = waiting[ fd ]
 
-    def clear_screen( self, _in_insert_mode ):
+            try:
+                data = os.read( fd, 65536 )
 
-        dbg_print( 'clear_screen: insert mode is ' + str( _in_insert_mode )  )
+            except OSError:
+                data = ''               ##  EIO, shell exited
 
-        self.write( '' + '\n' )    ##  new prompt
+            if data == '' and engine.daemon:
 
-        if clear_all == '1':
-            vim.command( 'normal ggdG' )
+                tail = engine.reattach()
 
-        self.end_exe_line()
+                if tail != None:
 
-        if clear_all == '0':
-            vim.command( 'normal zt' )
+                    ##  Same engine, new socket
 
-        if _in_insert_mode:
-            vim.command( 'startinsert!' )
+                    del waiting[ fd ]
 
-        else:
-            vim.command( 'stopinsert' )
+                    waiting[ engine.outd ] = engine
+                    last[ engine.outd ]    = last.pop( fd )
 
-################################################################################
+                    if prompt.has_key( fd ):
+                        prompt[ engine.outd ] = prompt.pop( fd )
 
-    def new_prompt( self ):
+                    fd   = engine.outd
+                    data = tail
 
-        self.execute_cmd( [''] )        #  just press enter
+                    if data == '':
+                        continue
 
-        vim.command( 'normal G$' )
-        vim.command( 'startinsert!' )
+            if data == '':
+                del waiting[ fd ]
+                continue
 
-################################################################################
+            last[ fd ] = time.time()
+            engine.render_chunk( data )
 
-    def get_vim_cursor_pos( self ):
+            if prompt.has_key( fd ) and ( engine.sink.partial + engine.partial )[ -len( prompt[ fd ] ): ] == prompt[ fd ]:
+                del waiting[ fd ]
 
-        cur_line, cur_row = vim.current.window.cursor
-        
-        return cur_line, cur_row + 1
+        now = time.time()
 
-################################################################################
+        for fd in waiting.keys():
+            if last[ fd ] + waiting[ fd ].delay <= now:
+                del waiting[ fd ]
 
-    def check_for_passwd( self ):
+    for e in _engines:
+        e.end_chunks()
 
-        cur_line, cur_row = self.get_vim_cursor_pos()
+################################################################################
 
-        prev_line = self.buffer[ cur_line - 1 ]
+def broadcast( _args ):
 
-        for regex in self.password_regex:
+    ##  :VimShBroadcast [-s name,name] cmd, run cmd in several vimsh buffers
+    ##  ( all of them by default ) at once.  Each buffer gets its own output
+    ##  and a summary buffer shows them side by side, sessions with the
+    ##  same output are listed together.
 
-            if re.search( regex, prev_line ):
+    args = string.strip( _args )
 
-                try:
-                    vim.command( 'let password = inputsecret( "Password? " )' )
+    targets = [ val for key, val in _BUFFERS_ if val.using_pty and not val.detached and val.pid ]
 
-                except KeyboardInterrupt:
-                    return
+    if args[ :3 ] == '-s ':
 
-                password = vim.eval( 'password' )
+        names, args = ( string.split( args[ 3: ], None, 1 ) + [ '' ] )[ :2 ]
+        names = [ '_' + n + '_' for n in string.split( names, ',' ) ]
 
-                self.execute_cmd( [password] )       ##  recursive call here...
+        targets = [ t for t in targets if t.filename in names ]
 
-################################################################################
+    if args == '' or not targets:
+        print 'vimsh: usage :VimShBroadcast [-s name,name] cmd ( pty buffers only )'
+        return
 
-    def pipe_read( self, _pipe, _minimum_to_read ):
+    ##  Whatever is in front of the cursor on each prompt line is that
+    ##  shell's prompt, reading stops when it shows up again.  Only the end
+    ##  of it ( '$ ', '> ' ) is looked for since cd etc change the rest.
 
-        ##  Hackaround since Windows doesn't support select() except for sockets.
+    prompts = []
 
-        dbg_print( 'pipe_read: minimum to read is ' + str( _minimum_to_read ) )
-        dbg_print( 'pipe_read: sleeping for ' + str( self.delay ) + ' seconds' )
+    for t in targets:
 
-        time.sleep( self.delay )
+        prompt  = t.buffer[ t.prompt_line - 1 ][ :t.prompt_cursor ]
+        visible = string.rstrip( prompt )
 
-        data  = ''
-        osfh  = msvcrt.get_osfhandle( _pipe )
+        prompts.append( prompt[ len( visible ) - 1: ] )
 
-        ( read, count, msg ) = PeekNamedPipe( osfh, 0 )
+    start = time.time()
 
-        dbg_print( 'pipe_read: initial count via PeekNamedPipe is ' + str( count ) )
+    ##  Read into memory so all the shells can be read in one loop, the
+    ##  buffers are updated afterwards
 
-        while ( count > 0 ):
+    switched = []           ##  targets reading into memory, put back below
 
-            dbg_print( 'pipe_read: reading from pipe' )
-            dbg_print( '' )
+    try:
 
-            ( err, tmp ) = ReadFile( osfh, count, None )
-            data += tmp
+        for t in targets:
 
-            dbg_print( 'pipe_read: read ' + str( tmp ) )
+            ##  Anything still coming from the last command goes to its
+            ##  buffer, not in with this one
 
-            ( read, count, msg ) = PeekNamedPipe( osfh, 0 )
+            if select.select( [ t.outd ], [], [], 0 )[ 0 ]:
+                t.read( 0 )
 
-            ##  Be sure to break the read, if asked to do so,
-            ##  after we've read in a line termination.
+            t.sink            = vimsh_memory_sink()
+            t.broadcast_start = t.stream_offset
+            switched.append( t )
 
-            if _minimum_to_read != 0 and len( data ) > 0 and data[ len( data ) -1 ] == '\n':
+            t.write( args + '\n' )
 
-                if len( data ) >= _minimum_to_read:
-                    dbg_print( 'pipe_read: found termination and read at least the minimum asked for' )
-                    break
+        read_many( switched, prompts, broadcast_timeout )
 
-                else:
-                    dbg_print( 'pipe_read: not all of the data has been read' )
+    finally:
 
-        dbg_print( 'pipe_read: returning' )
+        for t in switched:
 
-        return data
+            sink   = t.sink
+            t.sink = t
 
-################################################################################
+            t.append_output( args, sink.lines, sink.partial, t.broadcast_start )
+            t.broadcast_lines = sink.lines
 
-    def chk_stderr( self ):
+    add_history( args )
 
-        errors  = ''
-        dbg_print( 'chk_stderr: enter' )
+    elapsed = time.time() - start
 
-        if not self.using_pty:
+    ##  Group identical output
 
-            err_txt  = self.pipe_read( self.errd, 0 )
-            errors   = string.split( err_txt, '\n' )
+    groups = []
 
-            num_lines = len( errors )
-            dbg_print( 'chk_stderr: Number of error lines is ' + `num_lines` )
+    for t in targets:
 
-            last_line = errors[ num_lines - 1 ].strip()
+        for g in groups:
 
-            if last_line == '':
-                dbg_print( 'chk_stderr: Removing last line, it\'s empty' )
-                errors = errors[ :-1 ]
+            if g[ 1 ] == t.broadcast_lines:
+                g[ 0 ].append( t.filename )
+                break
 
-        return errors
+        else:
+            groups.append( ( [ t.filename ], t.broadcast_lines ) )
 
-################################################################################
-##                           Helper functions                                 ##
-################################################################################
-        
-def test_and_set( _vim_var, _default_val ):
+    summary = [ '%s  ( %d sessions, %d distinct, %.2f seconds )' % ( args, len( targets ), len( groups ), elapsed ) ]
 
-    ret = _default_val
+    for names, lines in groups:
+        summary.append( '== ' + string.join( names, ', ' ) )
+        summary.extend( lines )
 
-    vim.command( 'let dummy = exists( "' + _vim_var + '" )' )
-    exists = vim.eval( 'dummy' )
+    show_scratch( '_broadcast_', summary )
 
-    ##  exists will always be a string representation of the evaluation
+################################################################################
 
-    if exists != '0':
-        ret = vim.eval( _vim_var )
-        dbg_print( 'test_and_set: variable ' + _vim_var + ' exists, using supplied ' + ret )
+def show_scratch( _name, _lines ):
 
-    else:
-        dbg_print( 'test_and_set: variable ' + _vim_var + ' doesn\'t exist, using default ' + ret )
+    ##  Throwaway buffer in a new window for reports like :VimShStats
 
-    return ret
+    vim.command( 'new ' + _name )
+    vim.command( 'setlocal buftype=nofile bufhidden=wipe noswapfile nowrap' )
+
+    vim.current.buffer[:] = _lines
 
 ################################################################################
 
-def dump_str_as_hex( _str ):
+def raw_key_bytes( _key ):
 
-    hex_str = ''
+    ##  What getchar() returned in raw mode to what the pty should get.
+    ##  Plain keys are a number, special keys a string starting with
+    ##  K_SPECIAL ( 0x80 ), only the last two bytes say which key.
 
-    print 'length of string is ' + str( len( _str ) )
+    if _key[ :1 ] == '\x80':
+        return raw_special_keys.get( _key[ -2: ], '' )
 
-    for x in range( 0, len( _str ) ):
-        hex_str = hex_str + hex( ord( _str[x] ) ) + '\n'
+    code = int( _key )
 
-    print 'raw line ( hex ) is:'
-    print hex_str
+    if code < 256:
+        return chr( code )
+
+    return unichr( code ).encode( 'utf-8' )
 
 ################################################################################
 
-def dbg_print( _str ):
+def percentile( _sorted, _pct ):
 
-    if _DEBUG_:
-        print _str
+    return _sorted[ min( len( _sorted ) - 1, int( len( _sorted ) * _pct ) ) ]
 
 ################################################################################
 
-def new_buf( _filename ):
+def show_archive( _args ):
 
-    ##  If a buffer named vimsh doesn't exist create it, if it
-    ##  does, switch to it.  Use the config options for splitting etc.
+    ##  :VimShArchive lists the archived outputs, :VimShArchive n puts the
+    ##  nth one in a scratch buffer
 
-    filename = _filename
+    if not _ARCHIVE_ or not _ARCHIVE_.entries:
+        print 'vimsh: nothing archived'
+        return
 
-    try:
-        vim.command( 'let dummy = buflisted( "' + filename + '" )' )
-        exists = vim.eval( 'dummy' )
+    keys = _ARCHIVE_.keys()
+    args = string.strip( _args )
 
-        if exists == '0':
-            dbg_print( 'new_buf: buffer ' + filename + ' doesn\'t exist' )
+    if args == '':
 
-            if split_open == '0':
-                vim.command( 'edit ' + filename )
+        lines = [ '%d archived outputs, %d compressed bytes ( of %d )' % ( len( keys ), _ARCHIVE_.size, _ARCHIVE_.budget ) ]
 
-            else:
-                vim.command( 'new ' + filename )
+        for i in range( len( keys ) ):
 
-            vim.command( 'setlocal buftype=nofile' )
-            vim.command( 'setlocal bufhidden=hide' )
-            vim.command( 'setlocal noswapfile' )
-            vim.command( 'setlocal tabstop=4' )
-            vim.command( 'setlocal modifiable' )
-            vim.command( 'setlocal nowrap' )
-            vim.command( 'setlocal textwidth=999' )
-            vim.command( 'setfiletype vim_shell' )
+            cmd, when = keys[ i ]
+            name, count, data = _ARCHIVE_.entries[ keys[ i ] ]
 
-            vim.command( 'au BufDelete ' + filename + ' :python lookup_buf( "' + filename + '" ).cleanup()' )
+            lines.append( '%4d  %s  %-12s %6d lines  %s' % ( i + 1, time.strftime( '%H:%M:%S', time.localtime( when ) ),
+                                                             name, count, string.replace( cmd, '\n', '; ' ) ) )
 
-            vim.command( 'inoremap <buffer> <CR>  <ESC>:python lookup_buf( "' + filename + '" ).execute_cmd()<CR>' )
+        show_scratch( '_archive_', lines )
+        return
 
-            vim.command( 'inoremap <buffer> ' + timeout_key + ' <ESC>:python lookup_buf( "' + filename + '" ).set_timeout()<CR>' )
-            vim.command( 'nnoremap <buffer> ' + timeout_key + ' :python lookup_buf( "' + filename + '" ).set_timeout()<CR>' )
+    try:
+        key = keys[ int( args ) - 1 ]
 
-            vim.command( 'inoremap <buffer> ' + new_prompt_key + ' <ESC>:python lookup_buf ( "' + filename + '" ).new_prompt()<CR>' )
-            vim.command( 'nnoremap <buffer> ' + new_prompt_key + ' :python lookup_buf( "' + filename + '" ).new_prompt()<CR>' )
+        if int( args ) < 1:
+            raise IndexError
 
-            vim.command( 'inoremap <buffer> ' + page_output_key + ' <ESC>:python lookup_buf ( "' + filename + '" ).page_output()<CR>' )
-            vim.command( 'nnoremap <buffer> ' + page_output_key + ' :python lookup_buf( "' + filename + '" ).page_output()<CR>' )
+    except ( ValueError, IndexError ):
+        print 'vimsh: no archived output ' + args + ', :VimShArchive lists them'
+        return
 
-            vim.command( 'inoremap <buffer> ' + intr_signal_key + ' <ESC>:python lookup_buf ( "' + filename + '" ).send_intr()<CR>' )
-            vim.command( 'nnoremap <buffer> ' + intr_signal_key + ' :python lookup_buf( "' + filename + '" ).send_intr()<CR>' )
+    show_scratch( '_archive_', [ '$ ' + key[ 0 ] ] + _ARCHIVE_.get( key ) )
 
-            vim.command( 'inoremap <buffer> ' + clear_key + ' <ESC>:python lookup_buf ( "' + filename + '" ).clear_screen( True )<CR>')
-            vim.command( 'nnoremap <buffer> ' + clear_key + ' :python lookup_buf( "' + filename + '").clear_screen( False )<CR>' )
+################################################################################
 
-            if not self.using_pty:
-                vim.command( 'inoremap <buffer> ' + eof_signal_key + ' <ESC>:python lookup_buf ( "' + filename + '" ).send_eof()<CR>' )
-                vim.command( 'nnoremap <buffer> ' + eof_signal_key + ' :python lookup_buf( "' + filename + '" ).send_eof()<CR>' )
+def show_stats():
 
-            return 0
+    ##  :VimShStats, per buffer numbers in a scratch buffer
 
-        else:
+    lines = [ '%-16s %7s %10s %7s %7s %6s  %s' % ( 'buffer', 'pid', 'bytes', 'outputs', 'lines', 'keys', 'key to screen ms ( min/median/p95/max )' ) ]
 
-            dbg_print( 'new_buf: file ' + filename + ' exists' )
+    for filename, buf in _BUFFERS_:
 
-            vim.command( 'edit ' + filename )
-            return 1
+        latency = '-'
 
-    except:
-        dbg_print( 'new_buf: exception!' + str( sys.exc_info()[0] ) )
+        if buf.key_latency:
 
-################################################################################
+            ms = [ t * 1000 for t in buf.key_latency ]
+            ms.sort()
 
-def spawn_buf( _filename ):
+            latency = '%.1f / %.1f / %.1f / %.1f' % ( ms[ 0 ], percentile( ms, 0.5 ), percentile( ms, 0.95 ), ms[ -1 ] )
 
-    exists = new_buf( _filename )
+        lines.append( '%-16s %7s %10d %7d %7d %6d  %s' % ( filename, buf.pid, buf.stream_offset, len( buf.outputs ),
+                                                          len( buf.buffer ) + buf.evicted, buf.raw_keys, latency ) )
 
-    if not exists:
+    if len( lines ) == 1:
+        print 'vimsh: no vimsh buffers'
+        return
 
-        dbg_print( 'spawn_buf: buffer doesn\'t exist so creating a new one' )
-        
-        cur = vim.current.buffer
+    show_scratch( '_stats_', lines )
 
-        ##  Make vimsh associate buffer with _filename and add to list of buffers
-        vim_shell = vimsh( sh, arg, _filename )
+################################################################################
 
-        _BUFFERS_.append( ( _filename, vim_shell ) )
+def register_hook( _name, _kind, _func, _default = 0 ):
 
-        vim_shell.setup_pty( use_pty )
+    ##  Add a filter stage other scripts can turn on for a session with
+    ##  :VimShHook or vimsh.enable_hook().  _kind is one of:
+    ##
+    ##      'chunk'     raw output as read, before it's split into lines
+    ##      'line'      whole lines of output ( still ending in '\r' )
+    ##      'write'     text on its way to the shell
+    ##
+    ##  _func( vim_shell, items ) is given an iterable of strings and
+    ##  returns one, normally it's a generator so stages stream into each
+    ##  other.  With _default set it's on in every new session.
 
-        vim_shell.read( cur )
-        cur_line, cur_row = vim_shell.get_vim_cursor_pos()
+    if _kind not in ( 'chunk', 'line', 'write' ):
+        raise ValueError( 'register_hook: unknown kind ' + str( _kind ) )
 
-        ##  last line *should* be prompt, tuck it away for syntax hilighting
-        hi_prompt = cur[ cur_line - 1 ]
+    _HOOKS_[ _name ] = ( _kind, _func, _default )
 
-    else:
+################################################################################
 
-        dbg_print( 'main: buffer does exist' )
-        vim.command( 'normal G$' )
-        vim_shell = lookup_buf( _filename )
+def current_call( _method, *_args ):
 
-    vim.command( 'startinsert!' ) 
+    ##  Call a vimsh method for the current buffer, used by the commands
+
+    vim_shell = current_buf()
+
+    if vim_shell == None:
+        print 'vimsh: not a vimsh buffer'
+        return
+
+    return getattr( vim_shell, _method )( *_args )
 
 ################################################################################
 
@@ -1062,4 +4290,181 @@ if ( init_ok ):     ##  Only set this up if all modules were imported ok
 
     clear_key = test_and_set( 'g:vimsh_clear_key', '<C-l>' )
 
+    ##  Number of shells to keep pre-forked and waiting at their first prompt
+    ##  so new vimsh buffers open instantly.  Uses g:vimsh_sh/g:vimsh_sh_arg.
+    #  0 don't keep any ( default )
+    #
+
+    pool_size = int( test_and_set( 'g:vimsh_pool_size', '0' ) )
+
+    ##  Command history, shared by all vimsh sessions.  Set the file to ''
+    ##  to not keep any.  The keys recall older/newer commands starting
+    ##  with what's been typed at the prompt, :VimShHistory searches.
+
+    history_file     = test_and_set( 'g:vimsh_history_file', '~/.vimsh_history' )
+    history_prev_key = test_and_set( 'g:vimsh_history_prev_key', '<Up>' )
+    history_next_key = test_and_set( 'g:vimsh_history_next_key', '<Down>' )
+
+    ##  Complete command names ( from $PATH ) and filenames ( relative to
+    ##  the shell's current directory ) at the prompt
+
+    complete_key = test_and_set( 'g:vimsh_complete_key', '<Tab>' )
+
+    ##  Pick out compiler/test errors from output as it arrives and add them
+    ##  to the quickfix list, or the vimsh window's location list.
+    ##  :VimShErrors toggles it for a buffer.
+    #  0 off for new buffers ( default )
+    #  1 on for new buffers
+    #
+
+    errors_default = test_and_set( 'g:vimsh_errors', '0' )
+    errors_list    = test_and_set( 'g:vimsh_errors_list', 'quickfix' )     ##  or 'location'
+
+    ##  Roughly vim's default errorformat plus python and rust, first match
+    ##  wins.  Each needs 'file' and 'line' groups, 'col' and 'text' are
+    ##  optional.
+
+    error_regex = [ re.compile( r'\s*File "(?P<file>[^"]+)", line (?P<line>\d+)' ),              ##  python traceback
+                    re.compile( r'\s*--> (?P<file>[^:\s]+):(?P<line>\d+):(?P<col>\d+)' ),        ##  rustc
+                    re.compile( r'(?P<file>[^:\s][^:]*):(?P<line>\d+):(?:(?P<col>\d+):)?\s*(?P<text>.*)' ),   ##  gcc, make, pytest, grep -n
+                    re.compile( r'(?P<file>[^(\s][^(]*)\((?P<line>\d+)\) ?: (?P<text>.*)' ) ]   ##  msvc
+
+    ##  A match whose file doesn't exist only counts if the line has one of
+    ##  these, so timestamps and host:port don't end up in the list
+
+    error_word = re.compile( r'(?i)\b(error|warning|fatal)\b' )
+
+    ##  Show a run of identical lines ( log tails, retry loops ) as the first
+    ##  one and a counter that's updated in place.  :VimShCompact toggles it
+    ##  for a buffer.
+    #  0 off for new buffers ( default )
+    #  1 on for new buffers
+    #
+    #  g:vimsh_compact_mask  lines that match after replacing this regex
+    #                        with '#' count as the same, i.e. '\d+' to
+    #                        ignore timestamps and counts.  '' for exact.
+    #
+
+    compact_default = test_and_set( 'g:vimsh_compact', '0' )
+    compact_mask    = test_and_set( 'g:vimsh_compact_mask', '' )
+    compact_counter = '    [ repeated %d times ]'
+
+    if compact_mask:
+
+        try:
+            compact_mask = re.compile( compact_mask )
+
+        except re.error, e:
+            print 'vimsh: g:vimsh_compact_mask ignored, ' + str( e )
+            compact_mask = ''
+
+    ##  Keep a search index of all vimsh output for :VimShGrep.  Without it
+    ##  :VimShGrep still works but has to look at every line.
+    #  0 no index ( default )
+    #  1 index output as it's printed
+    #
+
+    if test_and_set( 'g:vimsh_grep_index', '0' ) == '1':
+        _INDEX_ = vimsh_search_index()
+
+    ##  Longest :VimShBroadcast waits for all the shells to show their
+    ##  prompt again, in seconds
+
+    broadcast_timeout = float( test_and_set( 'g:vimsh_broadcast_timeout', '60' ) )
+
+    ##  Prompts that get answered with inputsecret() instead of being typed
+    ##  into the buffer, put together into one regex.  Add your own as a
+    ##  regex in g:vimsh_password_regex.  Only the last password_tail
+    ##  characters of what was just read are looked at.
+
+    password_prompts = [ r'^\s*Password:',                 ##  su, ssh, ftp
+                         r'password:',                      ##  ???, seen this somewhere
+                         r'Password required',              ##  other ftp clients
+                         r'\[sudo\] password for',          ##  sudo
+                         r'[Pp]assphrase( for .*)?:\s*$',   ##  ssh keys, gpg
+                         r'PIN:\s*$' ]                      ##  gpg agent, smart cards
+
+    extra = test_and_set( 'g:vimsh_password_regex', '' )
+
+    if extra:
+
+        ##  A typo here mustn't stop the rest of the settings being set
+
+        try:
+            re.compile( extra )
+            password_prompts.append( extra )
+
+        except re.error, e:
+            print 'vimsh: g:vimsh_password_regex ignored, ' + str( e )
+
+    password_regex = re.compile( string.join( [ '(?:' + p + ')' for p in password_prompts ], '|' ) )
+    password_tail  = 256
+
+    ##  Commands handled by vimsh instead of the shell, first word to the
+    ##  vimsh method that gets the command
+
+    builtin_word = re.compile( r'\s*(\w+)\b' )
+    builtin_cmds = { 'clear' : 'handle_clear_cmd',
+                     'cls'   : 'handle_clear_cmd',
+                     'exit'  : 'handle_exit_cmd' }
+
+    ##  Raw mode ( :VimShRaw ), the key that goes back to normal vimsh and
+    ##  how long to wait for output/keys each time around, in seconds.
+    ##  Keys that aren't characters are sent as what an xterm would send.
+
+    raw_exit_key  = test_and_set( 'g:vimsh_raw_exit_key', '29' )      ##  ^]
+    raw_exit_name = test_and_set( 'g:vimsh_raw_exit_name', '^]' )
+    raw_poll      = float( test_and_set( 'g:vimsh_raw_poll', '0.01' ) )
+
+    raw_special_keys = { 'kb' : '\x7f',           ##  backspace
+                         'kD' : '\x1b[3~',        ##  delete
+                         'ku' : '\x1b[A',
+                         'kd' : '\x1b[B',
+                         'kr' : '\x1b[C',
+                         'kl' : '\x1b[D',
+                         'kh' : '\x1b[H',         ##  home
+                         '@7' : '\x1b[F',         ##  end
+                         'kP' : '\x1b[5~',        ##  page up
+                         'kN' : '\x1b[6~' }       ##  page down
+
+    ##  Keep outputs that get thrown away ( g:vimsh_clear_all ) compressed
+    ##  in memory, :VimShArchive lists and restores them.  Budget is in
+    ##  compressed bytes for all buffers together, 0 to keep nothing.
+
+    archive_size = int( test_and_set( 'g:vimsh_archive_size', '4194304' ) )
+
+    if archive_size > 0:
+        _ARCHIVE_ = vimsh_archive( archive_size )
+
+    ##  First line of a :VimShRecord file
+
+    record_magic = 'VIMSHREC1\n'
+
+    ##  Run shells in a separate vimsh daemon process so they ( and their
+    ##  scrollback ) survive vim exiting.  :VimShNewBuf with the same name
+    ##  attaches to the running shell again.
+    #  0 shells belong to vim ( default )
+    #  1 shells belong to the daemon
+    #
+    #  g:vimsh_daemon_socket      unix socket the daemon listens on, its
+    #                             directory must be yours and mode 0700
+    #  g:vimsh_daemon_scrollback  bytes of output kept per shell
+    #
+
+    use_daemon = '0'
+
+    if use_pty:
+
+        sock_dir = '/tmp/vimsh-' + str( os.getuid() )
+
+        if os.environ.get( 'XDG_RUNTIME_DIR' ):
+            sock_dir = os.path.join( os.environ[ 'XDG_RUNTIME_DIR' ], 'vimsh' )
+
+        use_daemon         = test_and_set( 'g:vimsh_daemon', '0' )
+        daemon_socket      = test_and_set( 'g:vimsh_daemon_socket', os.path.join( sock_dir, 'daemon' ) )
+        daemon_scrollback  = int( test_and_set( 'g:vimsh_daemon_scrollback', '262144' ) )
+
+    if use_pty and use_daemon != '1':
+        fill_pool()
+
     ############################ end customization #################################